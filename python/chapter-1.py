@@ -1,33 +1,232 @@
+import itertools
+import json
+import threading
 import time
 import unittest
+import uuid
+
+import redis
 
 # 准备好需要使用到的常量
 ONE_WEEK_IN_SECONDS = 7 * 86400
 VOTE_SCORE = 432
+# 群组排名缓存的新鲜期、旧副本的保留时间以及重建锁的超时时间
+GROUP_CACHE_TTL = 60
+GROUP_STALE_TTL = 3600
+GROUP_LOCK_TIMEOUT = 5
+# 为True时由 article_vote() 和 add_remove_groups() 直接维护每个群组的排名,
+# 开启之前需要先对已有的群组调用 build_incremental_group()
+INCREMENTAL_GROUPS = False
+# 投票去重的两种存储方式: 'set' 把用户名存储在集合里面,
+# 'bitmap' 把用户的数字ID存储在整数集合里面, 等到投票者足够稠密之后再把集合
+# 转换为以用户ID为偏移量的位图, 每个投票只占用一个二进制位. 位图的大小取决于
+# 最大的用户ID而不是投票者的数量, 所以只有投票者数量的 BITMAP_BYTES_PER_VOTER
+# 倍不小于位图的字节数时才进行转换, 投票者稀疏的文章一直使用集合
+VOTED_KEYS = {
+	'set': ('voted:', 'downvoted:'),
+	'bitmap': ('voted-bits:', 'downvoted-bits:'),
+}
+# 发布时间早于这个期限的文章会被归档程序移出实时的有序集合和群组集合,
+# 期限不能短于投票窗口, 否则仍然可以投票的文章也会被归档
+ARCHIVE_HORIZON = 4 * ONE_WEEK_IN_SECONDS
+# 每个归档散列存储的文章数量
+ARCHIVE_BUCKET_SIZE = 1000
+QUIT = False
+BITMAP_BYTES_PER_VOTER = 8
+
+# 进程内缓存的用户名到数字ID的映射, 映射一旦建立就不会改变
+USER_IDS = {}
+
+def intern_user(conn, user):
+	# 把用户名转换为一个稳定的数字ID, 以便作为位图的偏移量使用
+	uid = USER_IDS.get(user)
+	if uid is None:
+		uid = conn.hget('user-ids:', user)
+		if uid is None:
+			uid = conn.incr('user-id:')
+			# 如果有其他客户端抢先为这个用户分配了ID, 那么使用那个ID
+			if not conn.hsetnx('user-ids:', user, uid):
+				uid = conn.hget('user-ids:', user)
+		uid = USER_IDS[user] = int(uid)
+	return uid
+
+def add_vote(conn, key, member, dedup='set'):
+	# 在集合或位图里面记录一次投票; 对于位图, member 必须是 intern_user() 返回的ID.
+	# 返回真值表示这是用户的第一次投票
+	if dedup == 'bitmap':
+		return _add_voter_script(conn, [key], [member])
+	return conn.sadd(key, member)
+
+def has_voted(conn, key, member, dedup='set'):
+	# 检查用户是否已经投过票, 位图方式下的键可能是集合, 也可能是位图
+	if dedup == 'bitmap' and conn.type(key) == b'string':
+		return bool(conn.getbit(key, member))
+	return conn.sismember(key, member)
 
-def article_vote(conn, user, article):
+def article_vote(conn, user, article, dedup='set'):
 	# 计算文章的投票截止时间
 	cutoff = time.time() - ONE_WEEK_IN_SECONDS
 
 	# 检查是否还可以对文章进行投票(虽然使用散列也可以获取文章的发布时间,
 	# 但是有序集合返回的文章发布时间为浮点数, 可以不进行转换直接使用)
-	if conn.zscore('time:', article) < cutoff:
+	# 已经被归档的文章不再出现在 time: 里面, 同样视为投票已经截止
+	posted = conn.zscore('time:', article)
+	if posted is None or posted < cutoff:
 		return
 
 	# 从article:id标识符(identifier)里面取出文章的ID
 	article_id = article.partition(':')[-1]
 	# 如果用户是第一次为这篇文章投票, 那么增加这篇文章的投票数量和评分
-	if conn.sadd('voted:' + article_id, user):
+	if dedup == 'bitmap':
+		user = intern_user(conn, user)
+	if add_vote(conn, VOTED_KEYS[dedup][0] + article_id, user, dedup):
 		conn.zincrby('score:', article, VOTE_SCORE)
 		conn.hincrby(article, 'votes', 1)
+		if INCREMENTAL_GROUPS:
+			# 同时更新文章所属各个群组的评分排名, XX 选项保证不会把已经
+			# 离开群组的文章重新加回到排名里面(命令名使用小写, 是为了绕开
+			# redis-py 对 ZADD 返回值的整数转换, 因为 XX INCR 可能会返回空值)
+			for group in conn.smembers('groups:' + article_id):
+				conn.execute_command('zadd', 'score:' + group.decode(),
+					'XX', 'INCR', VOTE_SCORE, article)
+
+# 载入Lua脚本, 并返回一个在调用时会优先使用 EVALSHA 执行脚本的函数
+def script_load(script):
+	sha = [None]
+	def call(conn, keys=[], args=[], force_eval=False):
+		if not force_eval:
+			if not sha[0]:
+				# 如果脚本尚未被载入, 那么先载入它
+				sha[0] = conn.execute_command(
+					'SCRIPT', 'LOAD', script, parse='LOAD')
+			try:
+				return conn.execute_command(
+					'EVALSHA', sha[0], len(keys), *(keys+args))
+			except redis.exceptions.ResponseError as msg:
+				# 只有在服务器丢失了脚本缓存的情况下才会重新发送整个脚本
+				if not msg.args[0].startswith('NOSCRIPT'):
+					raise
+		return conn.execute_command(
+			'EVAL', script, len(keys), *(keys+args))
+	return call
+
+# 位图方式的投票记录: add_voter() 先把用户ID添加到集合里面, 投票者的数量
+# 每翻一倍就检查一次密度, 位图的字节数不超过 BITMAP_BYTES_PER_VOTER 倍的投票者
+# 数量时, 把集合原子地转换为位图(保留过期时间). remove_voter() 同时支持两种编码
+_VOTER_LUA = '''
+local function add_voter(key, uid)
+	if redis.call('type', key).ok == 'string' then
+		return 1 - redis.call('setbit', key, uid, 1)
+	end
+	local added = redis.call('sadd', key, uid)
+	local count = redis.call('scard', key)
+	if added == 0 or count < 64 or bit.band(count, count - 1) ~= 0 then
+		return added
+	end
+	local members = redis.call('smembers', key)
+	local top = 0
+	for _, member in ipairs(members) do
+		top = math.max(top, tonumber(member))
+	end
+	if (top + 8) / 8 <= count * %d then
+		local ttl = redis.call('pttl', key)
+		redis.call('del', key)
+		for _, member in ipairs(members) do
+			redis.call('setbit', key, member, 1)
+		end
+		if ttl > 0 then
+			redis.call('pexpire', key, ttl)
+		end
+	end
+	return added
+end
+
+local function remove_voter(key, uid)
+	if redis.call('type', key).ok == 'string' then
+		return redis.call('setbit', key, uid, 0)
+	end
+	return redis.call('srem', key, uid)
+end
+''' % BITMAP_BYTES_PER_VOTER
+
+_add_voter_script = script_load(_VOTER_LUA + '''
+return add_voter(KEYS[1], ARGV[1])
+''')
 
-def post_article(conn, user, title, link):
+# 在服务器端一次性完成截止时间检查、去重、评分更新和票数更新的投票脚本
+# KEYS: time:, score:, article:id, voted:id, downvoted:id, groups:id
+# ARGV: user, cutoff, VOTE_SCORE, 1(赞成)/-1(反对), ONE_WEEK_IN_SECONDS,
+#       是否维护群组排名(1/0), 去重方式('set'/'bitmap', 位图方式下 user 为数字ID)
+# 群组排名的键名是根据 groups:id 的内容在脚本里面拼出来的, 所以只适用于单机Redis
+_vote_script = script_load(_VOTER_LUA + '''
+local posted = redis.call('zscore', KEYS[1], KEYS[3])
+if not posted or tonumber(posted) < tonumber(ARGV[2]) then
+	return nil
+end
+local target, other = KEYS[4], KEYS[5]
+local field, other_field = 'votes', 'downvotes'
+if ARGV[4] == '-1' then
+	target, other = KEYS[5], KEYS[4]
+	field, other_field = 'downvotes', 'votes'
+end
+local bitmap = ARGV[7] == 'bitmap'
+local added
+if bitmap then
+	added = add_voter(target, ARGV[1])
+else
+	added = redis.call('sadd', target, ARGV[1])
+end
+if added == 0 then
+	return 0
+end
+if redis.call('ttl', target) < 0 then
+	redis.call('expireat', target, math.floor(tonumber(posted) + tonumber(ARGV[5])))
+end
+redis.call('hincrby', KEYS[3], field, 1)
+local delta = tonumber(ARGV[4]) * tonumber(ARGV[3])
+local removed
+if bitmap then
+	removed = remove_voter(other, ARGV[1])
+else
+	removed = redis.call('srem', other, ARGV[1])
+end
+if removed == 1 then
+	redis.call('hincrby', KEYS[3], other_field, -1)
+	delta = delta * 2
+end
+redis.call('zincrby', KEYS[2], delta, KEYS[3])
+if ARGV[6] == '1' then
+	for _, group in ipairs(redis.call('smembers', KEYS[6])) do
+		redis.call('zadd', 'score:' .. group, 'XX', 'INCR', delta, KEYS[3])
+	end
+end
+return delta
+''')
+
+def scripted_article_vote(conn, user, article, downvote=False, dedup='set'):
+	# 计算文章的投票截止时间
+	cutoff = time.time() - ONE_WEEK_IN_SECONDS
+	article_id = article.partition(':')[-1]
+	voted, downvoted = VOTED_KEYS[dedup]
+	if dedup == 'bitmap':
+		user = intern_user(conn, user)
+	# 所有检查和更新都在一次服务器端调用里面完成, 不会出现评分和票数不一致的情况.
+	# 返回None表示投票已经截止, 返回0表示用户已经投过同样的票,
+	# 否则返回文章评分的变化量(改投时变化量会翻倍)
+	return _vote_script(conn,
+		['time:', 'score:', article, voted + article_id,
+			downvoted + article_id, 'groups:' + article_id],
+		[user, cutoff, VOTE_SCORE, -1 if downvote else 1, ONE_WEEK_IN_SECONDS,
+			int(INCREMENTAL_GROUPS), dedup])
+
+def post_article(conn, user, title, link, dedup='set'):
 	# 生成一个新的文章ID
 	article_id = str(conn.incr('article:'))
 
-	voted = 'voted:' + article_id
+	voted = VOTED_KEYS[dedup][0] + article_id
 	# 将发布文章的用户添加到文章的已投票用户名单中
-	conn.sadd(voted, user)
+	add_vote(conn, voted,
+		intern_user(conn, user) if dedup == 'bitmap' else user, dedup)
 	# 将这个名单的过期时间设置为一周
 	conn.expire(voted, ONE_WEEK_IN_SECONDS)
 
@@ -47,46 +246,441 @@ def post_article(conn, user, title, link):
 	conn.zadd('time:', article, now)
 	return article_id
 
+def post_articles(conn, articles, chunk_size=1000, progress=None, dedup='set'):
+	# 批量发布文章, articles 是一个由 (user, title, link) 组成的可迭代对象
+	articles = iter(articles)
+	ids = []
+	posted = 0
+	start = time.time()
+	while True:
+		chunk = list(itertools.islice(articles, chunk_size))
+		if not chunk:
+			break
+
+		# 使用一次 INCRBY 为整块文章预留连续的ID
+		last_id = conn.incrby('article:', len(chunk))
+		first_id = last_id - len(chunk) + 1
+
+		now = time.time()
+		scores = []
+		times = []
+		# 整块文章的所有写入命令都通过同一个非事务流水线发送
+		pipe = conn.pipeline(False)
+		for article_id, (user, title, link) in zip(
+				range(first_id, last_id + 1), chunk):
+			article_id = str(article_id)
+			voted = VOTED_KEYS[dedup][0] + article_id
+			# 新文章只有发布者一个投票者, 两种去重方式都从集合开始
+			pipe.sadd(voted, intern_user(conn, user) if dedup == 'bitmap' else user)
+			pipe.expire(voted, ONE_WEEK_IN_SECONDS)
+
+			article = 'article:' + article_id
+			pipe.hmset(article, {
+				'title': title,
+				'link': link,
+				'poster': user,
+				'time': now,
+				'votes': 1,
+			})
+			scores.extend([article, now + VOTE_SCORE])
+			times.extend([article, now])
+			ids.append(article_id)
+		# 每一块文章只需要两个 ZADD 命令
+		pipe.zadd('score:', *scores)
+		pipe.zadd('time:', *times)
+		pipe.execute()
+
+		posted += len(chunk)
+		if progress:
+			# 汇报已经发布的文章数量以及每秒发布的文章数量
+			progress(posted, posted / ((time.time() - start) or 1e-6))
+	return ids
+
 ARTICLES_PER_PAGE = 25
 
-def get_articles(conn, page, order='score:'):
+def get_articles(conn, page, order='score:', fields=None):
 	# 设置获取文章的起始索引和结束索引
 	start = (page-1) * ARTICLES_PER_PAGE
 	end = start + ARTICLES_PER_PAGE - 1
 
 	#获取多个文章id
-	ids = conn.zrevrange(order, start, end) 
-	articles = []
+	ids = conn.zrevrange(order, start, end)
+	archived = []
+	# 实时的有序集合不足一页时, 剩下的部分从归档的有序集合里面继续分页.
+	# 归档文章都比实时文章更旧, 所以按 time: 分页时两者可以直接拼接. 按 score:
+	# 分页时归档的评分可能高于部分实时文章(归档时获得较多投票的旧文章),
+	# 这种拼接只保证先列出所有实时文章, 再按评分列出归档文章, 并不是全局的评分顺序
+	if len(ids) < ARTICLES_PER_PAGE:
+		live = start + len(ids) if ids else conn.zcard(order)
+		archived = conn.zrevrange('archive:' + order, max(start - live, 0), end - live)
+	# 用一次流水线往返取出整页文章的详细信息
+	return hydrate_articles(conn, ids, fields, archived)
+
+def hydrate_articles(conn, ids, fields=None, archived=()):
+	# 把所有 HGETALL (或者只取部分字段的 HMGET) 命令都放进同一个流水线里面,
+	# 这样无论一页有多少篇文章, 都只需要一次通信往返
+	pipe = conn.pipeline(False)
 	for id in ids:
-		# 根据文章ID获取文章的详细信息
-		article_data = conn.hgetall(id)
+		if fields:
+			pipe.hmget(id, fields)
+		else:
+			pipe.hgetall(id)
+	# 归档文章存储在按ID分桶的散列里面
+	for id in archived:
+		bucket, article_id = archive_bucket(id)
+		pipe.hget(bucket, article_id)
+
+	articles = []
+	results = pipe.execute() if ids or archived else []
+	for id, data in zip(ids, results):
+		# HMGET 返回的是值列表, 需要和字段名重新组合成字典
+		article_data = dict(zip(fields, data)) if fields else data
+		article_data['id'] = id
+		articles.append(article_data)
+	for id, data in zip(archived, results[len(ids):]):
+		# 把归档记录还原成与实时文章相同的格式
+		data = dict((k, v.encode()) for k, v in json.loads(data or '{}').items())
+		if fields:
+			article_data = dict((field, data.get(field)) for field in fields)
+		else:
+			article_data = dict((k.encode(), v) for k, v in data.items())
 		article_data['id'] = id
 		articles.append(article_data)
 	return articles
 
+# 把文章加入群组, 并按照文章当前的评分和发布时间把它添加到群组的排名里面
+# KEYS: score:, time:, article:id, groups:id, 以及每个群组的 group:, score:, time: 三个键
+# ARGV: 群组名字
+_add_groups_script = script_load('''
+local score = redis.call('zscore', KEYS[1], KEYS[3])
+local posted = redis.call('zscore', KEYS[2], KEYS[3])
+for i, group in ipairs(ARGV) do
+	local base = 4 + (i - 1) * 3
+	redis.call('sadd', KEYS[base + 1], KEYS[3])
+	redis.call('sadd', KEYS[4], group)
+	if score then
+		redis.call('zadd', KEYS[base + 2], score, KEYS[3])
+	end
+	if posted then
+		redis.call('zadd', KEYS[base + 3], posted, KEYS[3])
+	end
+end
+''')
+
 def add_remove_groups(conn, article_id, to_add=[], to_remove=[]):
 	# 构建存储文章信息的键名
 	article = 'article:' + article_id
-	# 将文章减价到它所属的群组里面
+	groups = 'groups:' + article_id
+	if INCREMENTAL_GROUPS and to_add:
+		# 读取评分和写入群组排名必须原子地执行, 否则两者之间的投票会丢失
+		keys = ['score:', 'time:', article, groups]
+		for group in to_add:
+			keys.extend(['group:' + group, 'score:' + group, 'time:' + group])
+		_add_groups_script(conn, keys, list(to_add))
+		to_add = []
+
+	pipe = conn.pipeline(True)
+	# 将文章加到它所属的群组里面, 并记录文章属于哪些群组
 	for group in to_add:
-		conn.sadd('group:' + group, article)
+		pipe.sadd('group:' + group, article)
+		pipe.sadd(groups, group)
 	for group in to_remove:
-	# 从群组里面移除文章
-		conn.srem('group:' + group, article)
+		# 从群组里面移除文章
+		pipe.srem('group:' + group, article)
+		pipe.srem(groups, group)
+		if INCREMENTAL_GROUPS:
+			pipe.zrem('score:' + group, article)
+			pipe.zrem('time:' + group, article)
+	pipe.execute()
 
-def get_group_articles(conn, group, page, order="score:"):
+def get_group_articles(conn, group, page, order="score:", fields=None):
 	# 为每个群组的每种排列顺序都创建一个键
 	key = order + group
-	# 检查是否有已缓存的排序结果, 如果没有的话现在就进行排序
-	if not  conn.exists(key):
-		conn.zinterstore(key,
-			['group:' + group, order],
-			aggregate = 'max',
-		)
-		# 让Redis在60秒后自动删除这个有序集合
-		conn.expire(key, 60)
+	# 增量模式下群组排名总是最新的, 可以直接分页
+	if not INCREMENTAL_GROUPS:
+		# 检查缓存的排序结果是否仍然新鲜, 以及是否有可以使用的旧副本
+		pipe = conn.pipeline(False)
+		pipe.exists('fresh:' + key)
+		pipe.exists(key)
+		fresh, cached = pipe.execute()
+		if not fresh:
+			refresh_group_ranking(conn, group, order, cached)
 	#调用之前定义的 get_articles()
-	return get_articles(conn, page, key)
+	return get_articles(conn, page, key, fields)
+
+# 只有在锁的值仍然是调用者的标识符时才删除锁, 避免重建时间超过锁的超时时间之后,
+# 误删其他客户端获得的锁
+_release_lock_script = script_load('''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+	return redis.call('del', KEYS[1])
+end
+return 0
+''')
+
+def refresh_group_ranking(conn, group, order="score:", cached=False):
+	key = order + group
+	lock = 'lock:' + key
+	identifier = str(uuid.uuid4())
+	# 只有拿到锁的客户端才会执行交集运算, 避免缓存过期时所有请求同时重建
+	while not conn.set(lock, identifier, nx=True, ex=GROUP_LOCK_TIMEOUT):
+		# 其他客户端正在重建排名, 有旧副本的话直接使用旧副本
+		if cached:
+			return False
+		# 没有旧副本可用, 等待重建完成; 如果重建者崩溃了,
+		# 那么锁会在超时之后过期, 由当前客户端接手重建
+		time.sleep(.001)
+		if conn.exists('fresh:' + key):
+			return False
+
+	pipe = conn.pipeline(True)
+	# ZINTERSTORE 会原子地替换旧的排名, 读者不会看到重建到一半的结果
+	pipe.zinterstore(key,
+		['group:' + group, order],
+		aggregate = 'max',
+	)
+	# 旧副本保留一段较长的时间, 以便在下次重建期间继续提供服务
+	pipe.expire(key, GROUP_STALE_TTL)
+	pipe.setex('fresh:' + key, 1, GROUP_CACHE_TTL)
+	pipe.execute()
+	_release_lock_script(conn, [lock], [identifier])
+	return True
+
+def build_incremental_group(conn, group):
+	# 为已有的群组一次性地构建两种排名, 在开启 INCREMENTAL_GROUPS 之前调用
+	pipe = conn.pipeline(True)
+	for order in ('score:', 'time:'):
+		key = order + group
+		pipe.zinterstore(key, ['group:' + group, order], aggregate='max')
+		pipe.persist(key)
+		pipe.delete('fresh:' + key)
+	pipe.execute()
+
+def migrate_voted_sets(conn, count=100):
+	# 把已有的 voted:/downvoted: 集合转换为位图方式的投票记录, 并保留原有的过期时间.
+	# 与 add_voter() 相同, 只有足够稠密的投票者才会被存储为位图.
+	# 迁移期间应该暂停使用集合方式的投票, 否则迁移之后写入集合的投票会被丢弃
+	migrated = 0
+	for old, new in zip(VOTED_KEYS['set'], VOTED_KEYS['bitmap']):
+		for key in list(conn.scan_iter(old + '*', count=count)):
+			key = key.decode()
+			article_id = key[len(old):]
+			pipe = conn.pipeline(False)
+			pipe.smembers(key)
+			pipe.ttl(key)
+			users, ttl = pipe.execute()
+
+			uids = [intern_user(conn, user.decode()) for user in users]
+			pipe = conn.pipeline(True)
+			if uids and (max(uids) + 8) // 8 <= len(uids) * BITMAP_BYTES_PER_VOTER:
+				for uid in uids:
+					pipe.setbit(new + article_id, uid, 1)
+			elif uids:
+				pipe.sadd(new + article_id, *uids)
+			if ttl:
+				pipe.expire(new + article_id, ttl)
+			pipe.delete(key)
+			pipe.execute()
+			migrated += 1
+	return migrated
+
+def memory_usage(conn, key):
+	# SAMPLES 0 让Redis统计集合里面的所有元素, 而不是进行抽样估算
+	return conn.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0) or 0
+
+def voted_memory_report(conn, sizes=(1000, 100000, 10000000), chunk=10000,
+		sparse=(1, 5, 50), max_id=10000000):
+	# 分别用集合和位图记录 n 个投票者, 返回每个投票平均占用的字节数.
+	# 稠密的情况假设用户ID是连续分配的; 'intern' 是用户名映射表的开销,
+	# 这个映射表由所有文章共享, 所以不会随文章的数量增长.
+	# 稀疏的情况模拟大多数文章: 少数几个ID接近 max_id 的投票者, 'bitmap' 是
+	# add_vote() 实际使用的编码, 'raw_bitmap' 是直接用 SETBIT 写入位图时的大小
+	report = []
+	for n in sizes:
+		pipe = conn.pipeline(False)
+		for start in range(0, n, chunk):
+			users = ['user:%s' % i for i in range(start, min(start + chunk, n))]
+			pipe.sadd('memory-report:set', *users)
+			pipe.hmset('memory-report:intern',
+				dict((user, start + i + 1) for i, user in enumerate(users)))
+			pipe.execute()
+		# 稠密分配的ID对应一个所有位都被设置的位图
+		conn.setrange('memory-report:bitmap', 0, b'\xff' * ((n + 1 + 7) // 8))
+
+		report.append({
+			'voters': n,
+			'set': memory_usage(conn, 'memory-report:set') / float(n),
+			'bitmap': memory_usage(conn, 'memory-report:bitmap') / float(n),
+			'intern': memory_usage(conn, 'memory-report:intern') / float(n),
+		})
+		conn.delete('memory-report:set', 'memory-report:bitmap', 'memory-report:intern')
+
+	for n in sparse:
+		uids = [max_id - i * 1000 for i in range(n)]
+		conn.sadd('memory-report:set', *['user:%s' % uid for uid in uids])
+		for uid in uids:
+			add_vote(conn, 'memory-report:bitmap', uid, 'bitmap')
+			conn.setbit('memory-report:raw', uid, 1)
+		report.append({
+			'voters': n,
+			'max_id': max_id,
+			'set': memory_usage(conn, 'memory-report:set') / float(n),
+			'bitmap': memory_usage(conn, 'memory-report:bitmap') / float(n),
+			'raw_bitmap': memory_usage(conn, 'memory-report:raw') / float(n),
+		})
+		conn.delete('memory-report:set', 'memory-report:bitmap', 'memory-report:raw')
+	return report
+
+def archive_bucket(article):
+	# 根据文章ID计算出存储归档记录的散列以及散列里面的字段
+	if isinstance(article, bytes):
+		article = article.decode()
+	article_id = article.partition(':')[-1]
+	return 'archive:articles:%s' % (int(article_id) // ARCHIVE_BUCKET_SIZE), article_id
+
+def archive_articles(conn, horizon=ARCHIVE_HORIZON, batch=100):
+	# 把最多 batch 篇发布时间早于 horizon 的文章移动到归档键里面, 返回被归档的文章数量
+	if horizon < ONE_WEEK_IN_SECONDS:
+		raise ValueError("horizon must not be shorter than the voting window")
+	cutoff = time.time() - horizon
+	# 找出最旧的一批文章
+	old = conn.zrangebyscore('time:', 0, cutoff, start=0, num=batch, withscores=True)
+	if not old:
+		return 0
+
+	# 用一次往返取出这些文章的评分、详细信息以及所属的群组
+	pipe = conn.pipeline(False)
+	for article, posted in old:
+		article_id = article.decode().partition(':')[-1]
+		pipe.zscore('score:', article)
+		pipe.hgetall(article)
+		pipe.smembers('groups:' + article_id)
+	results = pipe.execute()
+
+	pipe = conn.pipeline(True)
+	for i, (article, posted) in enumerate(old):
+		score, data, groups = results[3*i:3*i+3]
+		article_id = article.decode().partition(':')[-1]
+		# 把文章的评分和发布时间转移到归档的有序集合里面
+		pipe.zadd('archive:score:', article, score or posted)
+		pipe.zadd('archive:time:', article, posted)
+		pipe.zrem('score:', article)
+		pipe.zrem('time:', article)
+		for group in groups:
+			group = group.decode()
+			# 归档程序直接维护每个群组的归档排名, 读取时不需要再求交集
+			pipe.zadd('archive:score:' + group, article, score or posted)
+			pipe.zadd('archive:time:' + group, article, posted)
+			pipe.srem('group:' + group, article)
+			pipe.zrem('score:' + group, article)
+			pipe.zrem('time:' + group, article)
+		# 文章散列被压缩成一个JSON字符串, 和同一个ID段的其他文章存储在同一个散列里面
+		bucket, article_id = archive_bucket(article)
+		pipe.hset(bucket, article_id, json.dumps(
+			dict((k.decode(), v.decode()) for k, v in data.items()),
+			separators=(',', ':')))
+		pipe.delete(article, 'groups:' + article_id)
+	pipe.execute()
+	return len(old)
+
+def archiver(conn, horizon=ARCHIVE_HORIZON, batch=100, interval=60):
+	# 后台归档程序: 积压的文章较多时连续地归档, 否则休眠一段时间之后再检查
+	while not QUIT:
+		if archive_articles(conn, horizon, batch) < batch:
+			time.sleep(interval)
+
+#--------------- 以下是用于基准测试的辅助函数 --------------------------------
+# 原先逐篇调用 HGETALL 的实现, 只作为基准测试的对照组保留
+def _get_articles_looped(conn, page, order='score:'):
+	start = (page-1) * ARTICLES_PER_PAGE
+	end = start + ARTICLES_PER_PAGE - 1
+
+	ids = conn.zrevrange(order, start, end)
+	articles = []
+	for id in ids:
+		article_data = conn.hgetall(id)
+		article_data['id'] = id
+		articles.append(article_data)
+	return articles
+
+def percentile(samples, p):
+	# 对已经排好序的样本取出第p百分位的值
+	if not samples:
+		return 0.0
+	index = min(int(len(samples) * p), len(samples) - 1)
+	return samples[index]
+
+def count_round_trips(conn, callback):
+	# 通过包装单条命令的执行函数以及流水线的 execute() 来统计通信往返次数
+	trips = [0]
+	execute_command = conn.execute_command
+	make_pipeline = conn.pipeline
+
+	def counted_command(*args, **options):
+		trips[0] += 1
+		return execute_command(*args, **options)
+
+	def counted_pipeline(*args, **kwargs):
+		pipe = make_pipeline(*args, **kwargs)
+		execute = pipe.execute
+		def counted_execute(*eargs, **ekwargs):
+			if pipe.command_stack:
+				trips[0] += 1
+			return execute(*eargs, **ekwargs)
+		pipe.execute = counted_execute
+		return pipe
+
+	conn.execute_command = counted_command
+	conn.pipeline = counted_pipeline
+	try:
+		callback()
+	finally:
+		del conn.execute_command
+		del conn.pipeline
+	return trips[0]
+
+def benchmark_article_vote(conn, vote, threads=8, votes=1000, articles=10):
+	# 让多个线程同时以不同的用户身份进行投票, 返回每秒处理的投票数量
+	ids = [post_article(conn, 'poster', 'title', 'http://www.google.com')
+		for i in range(articles)]
+
+	def voter(offset):
+		for i in range(votes):
+			vote(conn, 'user:%s:%s' % (offset, i), 'article:' + ids[i % articles])
+
+	workers = [threading.Thread(target=voter, args=(i,)) for i in range(threads)]
+	start = time.time()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	duration = time.time() - start
+
+	for id in ids:
+		conn.delete('article:' + id, 'voted:' + id, 'downvoted:' + id)
+		conn.zrem('score:', 'article:' + id)
+		conn.zrem('time:', 'article:' + id)
+	return threads * votes / duration
+
+def benchmark_get_articles(conn, samples=1000, page=1, fields=None):
+	# 分别对逐篇获取和流水线批量获取两种实现进行计时,
+	# 返回每种实现的通信往返次数以及p50/p99延迟(毫秒)
+	results = {}
+	for name, callback in (
+			('looped', lambda: _get_articles_looped(conn, page)),
+			('batched', lambda: get_articles(conn, page, fields=fields))):
+		trips = count_round_trips(conn, callback)
+		timings = []
+		for i in range(samples):
+			start = time.time()
+			callback()
+			timings.append((time.time() - start) * 1000)
+		timings.sort()
+		results[name] = {
+			'round_trips': trips,
+			'p50': percentile(timings, .5),
+			'p99': percentile(timings, .99),
+		}
+	return results
 
 #--------------- 以下是用于测试代码的辅助函数 --------------------------------
 class TestCh01(unittest.TestCase):
@@ -96,6 +690,9 @@ class TestCh01(unittest.TestCase):
 
 	def tearDown(self):
 		del self.conn
+		global INCREMENTAL_GROUPS, QUIT
+		INCREMENTAL_GROUPS = False
+		QUIT = False
 		print()
 		print()
 
@@ -136,12 +733,259 @@ class TestCh01(unittest.TestCase):
 		print()
 		self.assertTrue(len(articles) >= 1)
 
+		print("We can fetch only the fields a listing page needs:")
+		articles = get_group_articles(conn, 'new_group', 1, fields=['title', 'votes'])
+		pprint.pprint(articles)
+		print()
+		self.assertEqual(set(articles[0]), set(['title', 'votes', 'id']))
+
 		to_del = (
             conn.keys("time:*") + conn.keys("voted:*") + conn.keys('score:*') +
-            conn.keys("article:*") + conn.keys("group:*")
+            conn.keys("article:*") + conn.keys("group:*") + conn.keys("groups:*") +
+            conn.keys("fresh:*")
 		)
 		if to_del:
 			conn.delete(*to_del)
 
+	def test_scripted_vote(self):
+		conn = self.conn
+
+		article_id = post_article(conn, 'username', 'A title', 'http://www.google.com')
+		article = 'article:' + article_id
+		score = conn.zscore('score:', article)
+
+		print("Voting up, voting again and then switching to a downvote:")
+		self.assertEqual(scripted_article_vote(conn, 'other_user', article), VOTE_SCORE)
+		self.assertEqual(scripted_article_vote(conn, 'other_user', article), 0)
+		self.assertEqual(scripted_article_vote(conn, 'other_user', article, True), -2 * VOTE_SCORE)
+		r = conn.hgetall(article)
+		print(r)
+		print()
+		self.assertEqual(r[b'votes'], b'1')
+		self.assertEqual(r[b'downvotes'], b'1')
+		self.assertEqual(conn.zscore('score:', article), score - VOTE_SCORE)
+		self.assertTrue(conn.sismember('downvoted:' + article_id, 'other_user'))
+		self.assertTrue(conn.ttl('downvoted:' + article_id) > 0)
+
+		print("Votes are rejected once the voting window has closed")
+		conn.zadd('time:', article, time.time() - ONE_WEEK_IN_SECONDS - 1)
+		self.assertEqual(scripted_article_vote(conn, 'late_user', article), None)
+
+		print("Comparing votes/sec for the two voting paths with 8 threads:")
+		print("article_vote:", benchmark_article_vote(conn, article_vote, votes=200))
+		print("scripted_article_vote:", benchmark_article_vote(conn, scripted_article_vote, votes=200))
+
+		to_del = (
+			conn.keys("time:*") + conn.keys("voted:*") + conn.keys("downvoted:*") +
+			conn.keys('score:*') + conn.keys("article:*"))
+		if to_del:
+			conn.delete(*to_del)
+
+	def test_group_rankings(self):
+		global INCREMENTAL_GROUPS
+		conn = self.conn
+
+		ids = post_articles(conn, [('username', 'title %s' % i, 'http://www.google.com') for i in range(3)])
+		for id in ids:
+			add_remove_groups(conn, id, ['new_group'])
+
+		print("The first reader rebuilds the cached group ranking...")
+		self.assertEqual(len(get_group_articles(conn, 'new_group', 1)), 3)
+		self.assertTrue(conn.exists('fresh:score:new_group'))
+		print("...and while someone else holds the rebuild lock, readers serve the stale copy")
+		conn.delete('fresh:score:new_group')
+		conn.set('lock:score:new_group', 1, ex=GROUP_LOCK_TIMEOUT)
+		add_remove_groups(conn, ids[0], [], ['new_group'])
+		self.assertEqual(len(get_group_articles(conn, 'new_group', 1)), 3)
+		conn.delete('lock:score:new_group')
+		self.assertEqual(len(get_group_articles(conn, 'new_group', 1)), 2)
+		self.assertFalse(conn.exists('lock:score:new_group'))
+		print("...and a builder whose lock expired does not release someone else's lock")
+		self.assertEqual(_release_lock_script(conn, ['lock:score:new_group'], ['other']), 0)
+		conn.set('lock:score:new_group', 'owner', ex=GROUP_LOCK_TIMEOUT)
+		self.assertEqual(_release_lock_script(conn, ['lock:score:new_group'], ['other']), 0)
+		self.assertEqual(conn.get('lock:score:new_group'), b'owner')
+		conn.delete('lock:score:new_group')
+		print()
+
+		print("In incremental mode votes and group changes update the rankings directly")
+		build_incremental_group(conn, 'new_group')
+		INCREMENTAL_GROUPS = True
+		# 排名不再过期 (redis-py 对没有过期时间的键返回None)
+		self.assertEqual(conn.ttl('score:new_group'), None)
+		add_remove_groups(conn, ids[0], ['new_group'])
+		article_vote(conn, 'other_user', 'article:' + ids[1])
+		scripted_article_vote(conn, 'another_user', 'article:' + ids[2], True)
+		for id in ids:
+			self.assertEqual(conn.zscore('score:new_group', 'article:' + id),
+				conn.zscore('score:', 'article:' + id))
+		self.assertEqual(conn.zcard('time:new_group'), 3)
+		articles = get_group_articles(conn, 'new_group', 1)
+		self.assertEqual(articles[0]['id'], b'article:' + ids[1].encode())
+		add_remove_groups(conn, ids[1], [], ['new_group'])
+		self.assertEqual(conn.zscore('score:new_group', 'article:' + ids[1]), None)
+		article_vote(conn, 'third_user', 'article:' + ids[1])
+		self.assertEqual(conn.zscore('score:new_group', 'article:' + ids[1]), None)
+
+		to_del = (
+			conn.keys("time:*") + conn.keys("voted:*") + conn.keys("downvoted:*") +
+			conn.keys('score:*') + conn.keys("article:*") + conn.keys("group:*") +
+			conn.keys("groups:*") + conn.keys("fresh:*") + conn.keys("lock:*"))
+		if to_del:
+			conn.delete(*to_del)
+
+	def test_bitmap_votes(self):
+		conn = self.conn
+		import pprint
+
+		print("Posting and voting with bitmap dedup instead of sets:")
+		article_id = post_article(conn, 'username', 'A title', 'http://www.google.com', 'bitmap')
+		article = 'article:' + article_id
+		self.assertFalse(conn.exists('voted:' + article_id))
+		self.assertTrue(conn.ttl('voted-bits:' + article_id) > 0)
+		article_vote(conn, 'other_user', article, 'bitmap')
+		article_vote(conn, 'other_user', article, 'bitmap')
+		self.assertEqual(conn.hget(article, 'votes'), b'2')
+		self.assertEqual(scripted_article_vote(conn, 'username', article, True, 'bitmap'), -2 * VOTE_SCORE)
+		self.assertEqual(conn.hget(article, 'votes'), b'1')
+		self.assertTrue(has_voted(conn, 'downvoted-bits:' + article_id, intern_user(conn, 'username'), 'bitmap'))
+		self.assertFalse(has_voted(conn, 'voted-bits:' + article_id, intern_user(conn, 'username'), 'bitmap'))
+		print(conn.hgetall(article))
+		print()
+
+		print("Migrating an existing voted set to a bitmap:")
+		old_id = post_article(conn, 'username', 'A title', 'http://www.google.com')
+		article_vote(conn, 'third_user', 'article:' + old_id)
+		self.assertEqual(migrate_voted_sets(conn), 1)
+		self.assertFalse(conn.exists('voted:' + old_id))
+		self.assertTrue(conn.ttl('voted-bits:' + old_id) > 0)
+		article_vote(conn, 'third_user', 'article:' + old_id, 'bitmap')
+		self.assertEqual(conn.hget('article:' + old_id, 'votes'), b'2')
+		print()
+
+		print("Sparse voters stay in a set, dense voters are converted to a bitmap:")
+		for uid in range(1000000, 1000128):
+			add_vote(conn, 'voted-bits:sparse', uid, 'bitmap')
+		self.assertEqual(conn.type('voted-bits:sparse'), b'set')
+		for uid in range(1, 129):
+			self.assertTrue(add_vote(conn, 'voted-bits:dense', uid, 'bitmap'))
+			if uid == 1:
+				conn.expire('voted-bits:dense', 100)
+		self.assertFalse(add_vote(conn, 'voted-bits:dense', 5, 'bitmap'))
+		self.assertEqual(conn.type('voted-bits:dense'), b'string')
+		self.assertTrue(conn.ttl('voted-bits:dense') > 0)
+		self.assertTrue(has_voted(conn, 'voted-bits:dense', 128, 'bitmap'))
+		self.assertFalse(has_voted(conn, 'voted-bits:dense', 129, 'bitmap'))
+		print()
+
+		print("Memory per vote for sets and bitmaps:")
+		report = voted_memory_report(conn, sizes=(1000, 10000))
+		pprint.pprint(report)
+		self.assertTrue(report[1]['bitmap'] < report[1]['set'])
+		for row in report[2:]:
+			self.assertTrue(row['bitmap'] <= row['set'])
+			self.assertTrue(row['bitmap'] < row['raw_bitmap'])
+
+		USER_IDS.clear()
+		to_del = (
+			conn.keys("time:*") + conn.keys("*voted*") + conn.keys('score:*') +
+			conn.keys("article:*") + conn.keys("user-id*"))
+		if to_del:
+			conn.delete(*to_del)
+
+	def test_archiver(self):
+		global QUIT
+		conn = self.conn
+
+		ids = post_articles(conn, [('username', 'title %s' % i, 'http://www.google.com') for i in range(30)])
+		for id in ids:
+			add_remove_groups(conn, id, ['new_group'])
+		# 把最早的10篇文章的发布时间改到归档期限之前
+		now = time.time()
+		for i, id in enumerate(ids[:10]):
+			posted = now - ARCHIVE_HORIZON - 3600 + i
+			conn.zadd('time:', 'article:' + id, posted)
+			conn.zadd('score:', 'article:' + id, posted + VOTE_SCORE)
+
+		print("Let's start an archiver thread that moves the old articles away")
+		t = threading.Thread(target=archiver, args=(conn,), kwargs={'batch': 4, 'interval': .1})
+		t.setDaemon(1)
+		t.start()
+		time.sleep(.5)
+		QUIT = True
+		t.join()
+		QUIT = False
+		self.assertEqual(conn.zcard('time:'), 20)
+		self.assertEqual(conn.zcard('archive:time:'), 10)
+		self.assertEqual(conn.zcard('archive:score:new_group'), 10)
+		self.assertEqual(conn.scard('group:new_group'), 20)
+		self.assertFalse(conn.exists('article:' + ids[0]))
+
+		print("Paging past the live articles switches over to the archive")
+		expected = [b'article:' + id.encode() for id in reversed(ids)]
+		for order in ('time:', 'score:'):
+			page = get_articles(conn, 1, order) + get_articles(conn, 2, order)
+			self.assertEqual([a['id'] for a in page], expected)
+		page = get_group_articles(conn, 'new_group', 2, fields=['title'])
+		self.assertEqual(page[-1], {'id': b'article:' + ids[0].encode(), 'title': b'title 0'})
+		self.assertEqual(get_articles(conn, 2, 'time:')[-1][b'poster'], b'username')
+		self.assertEqual(get_articles(conn, 3, 'time:'), [])
+		print()
+
+		print("Archived articles can no longer be voted on")
+		article_vote(conn, 'other_user', 'article:' + ids[0])
+		self.assertEqual(scripted_article_vote(conn, 'other_user', 'article:' + ids[0]), None)
+		self.assertFalse(conn.exists('article:' + ids[0]))
+
+		to_del = (
+			conn.keys("time:*") + conn.keys("voted:*") + conn.keys('score:*') +
+			conn.keys("article:*") + conn.keys("group:*") + conn.keys("groups:*") +
+			conn.keys("fresh:*") + conn.keys("archive:*"))
+		if to_del:
+			conn.delete(*to_del)
+
+	def test_post_articles(self):
+		conn = self.conn
+
+		reports = []
+		def progress(posted, rate):
+			print("Posted %s articles, %.0f articles/sec" % (posted, rate))
+			reports.append(posted)
+
+		print("Posting a batch of articles in chunks of 400:")
+		ids = post_articles(conn,
+			(('username', 'title %s' % i, 'http://www.google.com') for i in range(1000)),
+			chunk_size=400, progress=progress)
+		print()
+		self.assertEqual(reports, [400, 800, 1000])
+		self.assertEqual(len(set(ids)), 1000)
+		self.assertEqual(conn.zcard('score:'), 1000)
+		self.assertEqual(conn.hget('article:' + ids[-1], 'title'), b'title 999')
+		self.assertTrue(conn.sismember('voted:' + ids[0], 'username'))
+		self.assertEqual(int(conn.get('article:')), int(ids[-1]))
+
+		to_del = conn.keys("time:*") + conn.keys("voted:*") + conn.keys('score:*') + conn.keys("article:*")
+		if to_del:
+			conn.delete(*to_del)
+
+	def test_benchmark_get_articles(self):
+		conn = self.conn
+		import pprint
+
+		for i in range(ARTICLES_PER_PAGE):
+			post_article(conn, 'username', 'title %s' % i, 'http://www.google.com')
+
+		print("Comparing the per-article loop with the pipelined hydration:")
+		results = benchmark_get_articles(conn, samples=100)
+		pprint.pprint(results)
+		print()
+		self.assertEqual(results['looped']['round_trips'], ARTICLES_PER_PAGE + 1)
+		self.assertEqual(results['batched']['round_trips'], 2)
+		self.assertEqual(get_articles(conn, 1), _get_articles_looped(conn, 1))
+
+		to_del = conn.keys("time:*") + conn.keys("voted:*") + conn.keys('score:*') + conn.keys("article:*")
+		if to_del:
+			conn.delete(*to_del)
+
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file
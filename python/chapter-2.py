@@ -1,9 +1,19 @@
+import collections
+import hashlib
+from concurrent import futures
 import json
+import os
+import random
+import subprocess
+import sys
 import threading
 import time
 import unittest
 from urllib import parse
 import uuid
+import zlib
+
+import redis
 
 
 # 尝试获取并返回令牌对应的用户
@@ -11,7 +21,7 @@ def check_token(conn, token):
 	return conn.hget('login:', token)
 
 # 更新令牌
-def update_token(conn, token, user, item = None):
+def update_token(conn, token, user, item = None, decay = False):
 	# 获取当前的时间戳
 	timestamp = time.time()
 	# 维持令牌与已登录用户之间的映射
@@ -23,77 +33,426 @@ def update_token(conn, token, user, item = None):
 		conn.zadd('viewed:' + token, item, timestamp)
 		# 移除旧的记录, 只保持用户最近浏览过的25个商品
 		conn.zremrangebyrank('viewed:' + token, 0, -26)
-		conn.zincrby('viewed:', item, -1)
+		# 衰减模式下, 越新的浏览所占的权重就越大, 旧的浏览次数相当于在逐渐减半,
+		# 所以不再需要定期重写整个 viewed: 有序集合
+		if decay:
+			record_view(conn, item, timestamp)
+		else:
+			conn.zincrby('viewed:', item, -1)
+
+# 浏览权重每经过 DECAY_HALF_LIFE 秒就翻一倍, 与原先每5分钟把所有分值减半的效果相同;
+# 当权重超过 2 ** RENORMALIZE_EXPONENT 时, 需要对分值进行一次重新归一化
+DECAY_HALF_LIFE = 300
+RENORMALIZE_EXPONENT = 32
+
+# 衰减模式下记录浏览的键: viewed:, 权重的起始时间 viewed-epoch:, 重新归一化
+# 期间存在的缩放系数 viewed-rescale:, 以及已经缩放过的商品集合 viewed-rescaled:
+VIEWED_KEYS = ['viewed:', 'viewed-epoch:', 'viewed-rescale:', 'viewed-rescaled:']
+
+# 按照 viewed-epoch: 里面的起始时间计算浏览权重并记录浏览. 权重总是在服务器端按照
+# 当前的起始时间计算, 不会把旧的大权重加到已经缩放过的分值上面. renormalize_viewed()
+# 会先推进起始时间再分批缩放分值; 在此期间第一次写入尚未缩放的商品时, 先在这里把它的
+# 分值缩放到新的起始时间, 并把它加入 viewed-rescaled:, 之后分批缩放时会跳过它.
+# 所以每个商品恰好被缩放一次, 并发的浏览也不会被缩放掉
+_VIEW_WEIGHT_LUA = '''
+local function add_view(keys, item, now, half_life)
+	local epoch = redis.call('get', keys[2])
+	if not epoch then
+		redis.call('set', keys[2], now)
+		epoch = now
+	end
+	local factor = redis.call('get', keys[3])
+	if factor and redis.call('sadd', keys[4], item) == 1 then
+		local score = redis.call('zscore', keys[1], item)
+		if score then
+			redis.call('zadd', keys[1], tonumber(score) * tonumber(factor), item)
+		end
+	end
+	local weight = 2 ^ ((tonumber(now) - tonumber(epoch)) / tonumber(half_life))
+	return redis.call('zincrby', keys[1], -weight, item)
+end
+'''
 
 # 清理旧的会话
 QUIT = False
 LIMIT = 10000000
-def clean_sessions(conn):
-	while not QUIT:
-		# 找出目前已有令牌的数量
-		size = conn.zcard('recent:')
-		# 令牌数量未超过限制, 休眠并在之后重新检查
-		if size <= LIMIT:
-			time.sleep(1)
-			continue
-
-		end_index = min(size - LIMIT, 100)
-		# 获取需要移除的令牌ID
-		tokens = conn.zrange('recent:', 0, end_index-1)
-
-		session_keys = []
+# 每批最多清理的令牌数量, 以及积压为零时的休眠时间
+REAP_MAX_BATCH = 10000
+REAP_MAX_SLEEP = 1
+# 清理程序的运行指标: 累计清理数量、当前积压数量以及每秒清理的令牌数量
+REAPER_STATS = {'reaped': 0, 'backlog': 0, 'rate': 0.0}
+
+# 载入Lua脚本, 并返回一个在调用时会优先使用 EVALSHA 执行脚本的函数
+def script_load(script):
+	sha = [None]
+	def call(conn, keys=[], args=[], force_eval=False):
+		if not force_eval:
+			if not sha[0]:
+				# 如果脚本尚未被载入, 那么先载入它
+				sha[0] = conn.execute_command(
+					'SCRIPT', 'LOAD', script, parse='LOAD')
+			try:
+				return conn.execute_command(
+					'EVALSHA', sha[0], len(keys), *(keys+args))
+			except redis.exceptions.ResponseError as msg:
+				# 只有在服务器丢失了脚本缓存的情况下才会重新发送整个脚本
+				if not msg.args[0].startswith('NOSCRIPT'):
+					raise
+		return conn.execute_command(
+			'EVAL', script, len(keys), *(keys+args))
+	return call
+
+# KEYS: VIEWED_KEYS
+# ARGV: item, timestamp, DECAY_HALF_LIFE
+_record_view_script = script_load(_VIEW_WEIGHT_LUA + '''
+return add_view(KEYS, ARGV[1], ARGV[2], ARGV[3])
+''')
+
+def record_view(conn, item, now=None):
+	# 按照衰减权重记录一次商品浏览, 返回商品的新分值
+	return float(_record_view_script(conn, VIEWED_KEYS,
+		[item, now or time.time(), DECAY_HALF_LIFE]))
+
+# 用一次调用算出积压数量, 并取出与积压数量相当(但不超过上限)的一批最旧令牌
+# KEYS: recent:  ARGV: LIMIT, REAP_MAX_BATCH
+_oldest_tokens_script = script_load('''
+local backlog = redis.call('zcard', KEYS[1]) - tonumber(ARGV[1])
+if backlog <= 0 then
+	return {0}
+end
+local tokens = redis.call('zrange', KEYS[1], 0, math.min(backlog, tonumber(ARGV[2])) - 1)
+table.insert(tokens, 1, backlog)
+return tokens
+''')
+
+def reap_sessions(conn, prefixes=('viewed:',)):
+	# 清理一批超出 LIMIT 的最旧会话, 返回清理前的积压数量以及清理的令牌数量
+	tokens = _oldest_tokens_script(conn, ['recent:'], [LIMIT, REAP_MAX_BATCH])
+	backlog = tokens.pop(0)
+	if tokens:
 		# 为那些将要被删除的令牌构建键名
-		for token in tokens:
-			session_keys.append('viewed:' + token)
+		session_keys = [prefix + token.decode() for token in tokens for prefix in prefixes]
+		# 整批删除操作通过一个事务流水线一次发送
+		pipe = conn.pipeline(True)
+		pipe.delete(*session_keys)
+		# 移除最旧的令牌
+		pipe.hdel('login:', *tokens)
+		pipe.zrem('recent:', *tokens)
+		pipe.execute()
+	return backlog, len(tokens)
+
+def _run_reaper(conn, prefixes):
+	window_start = time.time()
+	window_reaped = 0
+	while not QUIT:
+		backlog, reaped = reap_sessions(conn, prefixes)
+		remaining = backlog - reaped
 
-		conn.delete(*session_keys)
-		# 移除最旧的键名
-		conn.hdel('login:', *tokens)
-		conn.zrem('recent:', *tokens)
+		# 更新运行指标, 每秒计算一次清理速度
+		REAPER_STATS['reaped'] += reaped
+		REAPER_STATS['backlog'] = remaining
+		window_reaped += reaped
+		elapsed = time.time() - window_start
+		if elapsed >= 1:
+			REAPER_STATS['rate'] = window_reaped / elapsed
+			window_start = time.time()
+			window_reaped = 0
+
+		# 仍有积压时立即处理下一批; 积压越少, 休眠的时间就越接近 REAP_MAX_SLEEP
+		if remaining <= 0:
+			time.sleep(REAP_MAX_SLEEP)
+		elif remaining < REAP_MAX_BATCH:
+			time.sleep(REAP_MAX_SLEEP * (1 - remaining / float(REAP_MAX_BATCH)) / 10)
+
+def clean_sessions(conn):
+	_run_reaper(conn, ('viewed:',))
 
 # 更新购物车
 def add_to_cart(conn, session, item, count):
 	if count <= 0:
 		# 从购物车里面移除指定的商品
-		conn.hrem('cart:' + session, item)
+		conn.hdel('cart:' + session, item)
 	else:
 		# 将指定的商品添加购物车中
 		conn.hset('cart:' + session, item, count)
 
+def update_cart(conn, session, changes):
+	# 一次性地应用多个商品的数量变化, changes 是一个商品到数量的字典,
+	# 数量不大于0的商品会被移除. 所有修改和读取只需要一次通信往返, 返回修改之后的购物车
+	cart = 'cart:' + session
+	pipe = conn.pipeline(True)
+	remove = [item for item, count in changes.items() if count <= 0]
+	update = dict((item, count) for item, count in changes.items() if count > 0)
+	if remove:
+		pipe.hdel(cart, *remove)
+	if update:
+		pipe.hmset(cart, update)
+	pipe.hgetall(cart)
+	return pipe.execute()[-1]
+
+# 把一个购物车合并到另一个购物车里面, 相同商品的数量相加, 并且可以限制每种商品的最大数量
+# KEYS: 被合并的购物车, 合并到的购物车  ARGV: 数量上限(0表示不限制)
+_merge_carts_script = script_load('''
+local cap = tonumber(ARGV[1])
+local items = redis.call('hgetall', KEYS[1])
+for i = 1, #items, 2 do
+	local count = tonumber(items[i + 1]) + tonumber(redis.call('hget', KEYS[2], items[i]) or '0')
+	if cap > 0 and count > cap then
+		count = cap
+	end
+	redis.call('hset', KEYS[2], items[i], count)
+end
+redis.call('del', KEYS[1])
+return redis.call('hgetall', KEYS[2])
+''')
+
+def merge_carts(conn, from_session, to_session, cap=None):
+	# 例如用户登录时把匿名会话的购物车合并到已登录会话的购物车里面, 返回合并之后的购物车
+	items = _merge_carts_script(conn,
+		['cart:' + from_session, 'cart:' + to_session], [cap or 0])
+	return dict(zip(items[::2], items[1::2]))
+
 def clean_full_sessions(conn):
-	while not QUIT:
-		size = conn.zcard('recent')
-		if size <= LIMIT:
-			time.sleep(1)
-			continue
-		end_index = min(size - LIMIT, 100)
-		sessions = conn.zrange('recent:', 0, end_index - 1)
-
-		session_keys = []
-		for sess in sessions:
-			session_keys.append('viewed:' + sess)
-			# 用于删除旧的会话对应用户的购物车
-			session_keys.append('cart:' + sess)
-		conn.delete(*session_keys)
-		conn.hdel('login:', *sessions)
-		conn.zrem('recent:', *sessions)
-
-def cache_request(conn, request, callback):
+	# 用于删除旧的会话对应用户的购物车
+	_run_reaper(conn, ('viewed:', 'cart:'))
+
+# 紧凑的会话布局: 每个会话只使用一个散列 session:<token>, 其中 user 字段代替
+# login: 里面的映射, seen 字段记录最后访问时间(整数秒), v:<item> 字段记录最近浏览的
+# 商品及其浏览序号(由 n 字段递增生成), c:<item> 字段记录购物车里面的商品数量.
+# 字段数量少, 字段值大多是小整数, 所以Redis会使用紧凑的 ziplist/listpack 编码存储这个散列
+SESSION_VIEWED_LIMIT = 25
+
+# KEYS: session:<token>, recent:, 以及 VIEWED_KEYS
+# ARGV: token, user, timestamp, item(可以为空), 是否使用衰减权重(1/0),
+#       SESSION_VIEWED_LIMIT, DECAY_HALF_LIFE
+_update_packed_token_script = script_load(_VIEW_WEIGHT_LUA + '''
+redis.call('hmset', KEYS[1], 'user', ARGV[2], 'seen', math.floor(tonumber(ARGV[3])))
+redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])
+if ARGV[4] ~= '' then
+	redis.call('hset', KEYS[1], 'v:' .. ARGV[4], redis.call('hincrby', KEYS[1], 'n', 1))
+	-- 只保留最近浏览过的 SESSION_VIEWED_LIMIT 个商品
+	local fields = redis.call('hgetall', KEYS[1])
+	local viewed = {}
+	for i = 1, #fields, 2 do
+		if string.sub(fields[i], 1, 2) == 'v:' then
+			table.insert(viewed, {fields[i], tonumber(fields[i + 1])})
+		end
+	end
+	if #viewed > tonumber(ARGV[6]) then
+		table.sort(viewed, function(a, b) return a[2] < b[2] end)
+		for i = 1, #viewed - tonumber(ARGV[6]) do
+			redis.call('hdel', KEYS[1], viewed[i][1])
+		end
+	end
+	if ARGV[5] == '1' then
+		add_view({KEYS[3], KEYS[4], KEYS[5], KEYS[6]}, ARGV[4], ARGV[3], ARGV[7])
+	else
+		redis.call('zincrby', KEYS[3], -1, ARGV[4])
+	end
+end
+''')
+
+def check_packed_token(conn, token):
+	return conn.hget('session:' + token, 'user')
+
+def update_packed_token(conn, token, user, item=None, decay=False):
+	# 与 update_token() 作用相同, 但是所有会话数据都写入同一个散列, 并且只需要一次通信往返
+	_update_packed_token_script(conn,
+		['session:' + token, 'recent:'] + VIEWED_KEYS,
+		[token, user, time.time(), item or '', int(decay), SESSION_VIEWED_LIMIT,
+			DECAY_HALF_LIFE])
+
+def get_packed_session(conn, token):
+	# 把会话散列还原成用户、最后访问时间、最近浏览的商品(从新到旧)以及购物车
+	data = conn.hgetall('session:' + token)
+	viewed = []
+	cart = {}
+	for field, value in data.items():
+		field = field.decode()
+		if field.startswith('v:'):
+			viewed.append((int(value), field[2:]))
+		elif field.startswith('c:'):
+			cart[field[2:]] = int(value)
+	viewed.sort(reverse=True)
+	return {
+		'user': data.get(b'user'),
+		'seen': int(data[b'seen']) if b'seen' in data else None,
+		'viewed': [item for seen, item in viewed],
+		'cart': cart,
+	}
+
+def add_to_packed_cart(conn, token, item, count):
+	if count <= 0:
+		conn.hdel('session:' + token, 'c:' + item)
+	else:
+		conn.hset('session:' + token, 'c:' + item, count)
+
+def clean_packed_sessions(conn):
+	# 删除会话散列就同时删除了登录信息、浏览记录以及购物车
+	_run_reaper(conn, ('session:',))
+
+def migrate_sessions(conn, count=1000, prefix=''):
+	# 把 login:/viewed:<token>/cart:<token> 布局的会话转换为紧凑布局, 返回被转换的会话数量.
+	# 迁移期间应该暂停写入旧布局, recent: 有序集合保持不变. prefix 会被加在所有
+	# 键名的前面, 以便在与线上数据隔离的键上进行迁移
+	migrated = 0
+	cursor = '0'
+	while True:
+		cursor, sessions = conn.hscan(prefix + 'login:', cursor, count=count)
+		tokens = [token.decode() for token in sessions]
+		if tokens:
+			pipe = conn.pipeline(False)
+			for token in tokens:
+				pipe.zscore(prefix + 'recent:', token)
+				pipe.zrevrange(prefix + 'viewed:' + token, 0, SESSION_VIEWED_LIMIT - 1, withscores=True)
+				pipe.hgetall(prefix + 'cart:' + token)
+			results = pipe.execute()
+
+			pipe = conn.pipeline(True)
+			for i, token in enumerate(tokens):
+				seen, viewed, cart = results[3*i:3*i+3]
+				session = {
+					'user': sessions[token.encode()],
+					'seen': int(seen or time.time()),
+					'n': len(viewed),
+				}
+				# 按照从旧到新的顺序为浏览过的商品分配序号
+				for number, (item, timestamp) in enumerate(reversed(viewed)):
+					session[b'v:' + item] = number + 1
+				for item, quantity in cart.items():
+					session[b'c:' + item] = quantity
+				pipe.hmset(prefix + 'session:' + token, session)
+				pipe.delete(prefix + 'viewed:' + token, prefix + 'cart:' + token)
+			pipe.hdel(prefix + 'login:', *tokens)
+			pipe.execute()
+			migrated += len(tokens)
+		if not int(cursor):
+			break
+	return migrated
+
+def session_memory_report(conn, sessions=10000, viewed=25, cart=3):
+	# 在 memory-report: 前缀下创建一批旧布局的会话, 迁移到紧凑布局, 分别统计每个会话
+	# 占用的内存字节数. 所有数据都写入独立的键, 不会读取或者修改线上的会话;
+	# 两种布局共用的 recent: 有序集合不计入统计
+	prefix = 'memory-report:'
+	tokens = ['token%s' % i for i in range(sessions)]
+
+	def usage(keys):
+		total = 0
+		for start in range(0, len(keys), 1000):
+			pipe = conn.pipeline(False)
+			for key in keys[start:start + 1000]:
+				pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0)
+			total += sum(size or 0 for size in pipe.execute())
+		return total
+
+	now = time.time()
+	for start in range(0, sessions, 1000):
+		pipe = conn.pipeline(False)
+		for i in range(start, min(start + 1000, sessions)):
+			token = tokens[i]
+			pipe.zadd(prefix + 'recent:', token, now + i)
+			pipe.hset(prefix + 'login:', token, 'user%s' % i)
+			for j in range(viewed):
+				pipe.zadd(prefix + 'viewed:' + token, 'item%s' % j, now + i + j)
+			for j in range(cart):
+				pipe.hset(prefix + 'cart:' + token, 'item%s' % j, j + 1)
+		pipe.execute()
+	original = usage([prefix + 'login:'] +
+		[prefix + kind + token for token in tokens for kind in ('viewed:', 'cart:')])
+
+	migrate_sessions(conn, prefix=prefix)
+	packed = usage([prefix + 'session:' + token for token in tokens])
+
+	for start in range(0, sessions, 1000):
+		conn.delete(*[prefix + 'session:' + token for token in tokens[start:start + 1000]])
+	conn.delete(prefix + 'recent:', prefix + 'login:')
+	return {
+		'sessions': sessions,
+		'original': original / float(sessions),
+		'packed': packed / float(sessions),
+	}
+
+class LocalPageCache(object):
+	# 进程内的一级页面缓存: 按照最近最少使用(LRU)的顺序淘汰页面,
+	# 所有页面的总大小不超过 max_bytes, 每个页面最多缓存 ttl 秒
+	def __init__(self, max_bytes=64 * 1024 * 1024, ttl=5):
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.size = 0
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.stats['misses'] += 1
+				return None
+			expires, content = entry
+			if expires < time.time():
+				# 页面已经过期, 从一级缓存里面移除
+				self._remove(key)
+				self.stats['expired'] += 1
+				self.stats['misses'] += 1
+				return None
+			# 把被访问的页面移动到最近使用的一端
+			self.entries.move_to_end(key)
+			self.stats['hits'] += 1
+			return content
+
+	def set(self, key, content):
+		if len(content) > self.max_bytes:
+			return
+		with self.lock:
+			if key in self.entries:
+				self._remove(key)
+			self.entries[key] = (time.time() + self.ttl, content)
+			self.size += len(content)
+			# 超出字节预算时, 从最久未使用的一端开始淘汰页面
+			while self.size > self.max_bytes:
+				self._remove(next(iter(self.entries)))
+				self.stats['evictions'] += 1
+
+	def _remove(self, key):
+		expires, content = self.entries.pop(key)
+		self.size -= len(content)
+
+def cache_request(conn, request, callback, local=None, index=None, vary=None):
+	#将请求转换成一个简单的字符串键,方便之后进行查找
+	page_key = 'cache:' + hash_request(request, vary)
+	# 带有防缓存参数 _ 的请求总是重新生成, 不能被一级缓存里面的页面命中
+	if is_dynamic(request):
+		return callback(request)
+	# 一级缓存只保存可以被缓存的页面, 命中时不需要和Redis进行任何通信
+	if local is not None:
+		content = local.get(page_key)
+		if content is not None:
+			return content
+
 	# 对于不能被缓存的请求, 直接调用回调函数
-	if not can_cache(conn, request):
+	if not can_cache(conn, request, index):
 		return callback(request)
 
-	#将请求转换成一个简单的字符串键,方便之后进行查找
-	page_key = 'cache:' + hash_request(request)
 	# 尝试查找被缓存的页面
 	content = conn.get(page_key)
 
 	if not content:
 		# 如果页面还没有被缓存, 那么生成页面
 		content = callback(request)
-		# 将新生成的页面放到缓存里面
-		conn.setex(page_key, content, 300)
+		# 将新生成的页面压缩之后放到缓存里面
+		data = content.encode('utf-8') if isinstance(content, str) else content
+		conn.setex(page_key, zlib.compress(data), 300)
+	else:
+		try:
+			content = zlib.decompress(content)
+		except zlib.error:
+			# 兼容在启用压缩之前写入的未压缩页面
+			pass
 
+	if local is not None:
+		local.set(page_key, content)
 	return content #返回页面
 
 def schedule_row_cache(conn, row_id, delay):
@@ -102,32 +461,56 @@ def schedule_row_cache(conn, row_id, delay):
 	# 立即对需要缓存的数据行进行调度
 	conn.zadd('schedule:', row_id, time.time())
 
-def cache_rows(conn):
-	while not QUIT:
-		next = conn.zrange('schedule:', 0, 0, withscores=True)
-		now = time.time()
+# 原子地认领所有到期的数据行: 需要继续缓存的行会被重新调度到 now + lease,
+# 这样其他刷新进程就不会在租约期内重复刷新这些行; 延迟值不大于0的行会被移出调度.
+# KEYS: schedule:, delay:  ARGV: now, lease, 每次最多认领的行数
+_claim_rows_script = script_load('''
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+local claimed = {}
+for _, row in ipairs(due) do
+	local delay = tonumber(redis.call('zscore', KEYS[2], row) or '0')
+	if delay <= 0 then
+		redis.call('zrem', KEYS[1], row)
+		redis.call('zrem', KEYS[2], row)
+	else
+		redis.call('zadd', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[2]), row)
+	end
+	table.insert(claimed, row)
+	table.insert(claimed, tostring(delay))
+end
+return claimed
+''')
 
-		# 尝试获取下一个需要被缓存的数据行以及该行的调度时间戳,
-		# 命令会返回一个包含零个或一个元组(tuple)的列表
-		if not next or next[0][1]:
-			# 暂时没有行需要被缓存, 休息50毫秒后重试
-			time.sleep(.05)
-			continue
+def refresh_rows(conn, pool, batch=1000, lease=30):
+	# 认领一批到期的数据行并刷新它们的缓存, 返回被处理的行数
+	now = time.time()
+	claimed = _claim_rows_script(conn, ['schedule:', 'delay:'], [now, lease, batch])
+	rows = [(claimed[i].decode(), float(claimed[i+1])) for i in range(0, len(claimed), 2)]
+	if not rows:
+		return 0
 
-		# 提前获取下一次调度的延迟时间
-		delay = conn.zscore('delay:', row_id)
+	# 在线程池里面并发地读取需要缓存的数据行
+	refresh = [row_id for row_id, delay in rows if delay > 0]
+	values = pool.map(lambda row_id: json.dumps(Inventory.get(row_id).to_dict()), refresh)
+
+	pipe = conn.pipeline(True)
+	for row_id, delay in rows:
 		if delay <= 0:
 			# 不必再缓存这个行, 将它从缓存中移除
-			conn.zrem('delay:', row_id)
-			conn.zrem('schedule:', row_id)
-			conn.delete('inv:' + row_id)
-			continue
+			pipe.delete('inv:' + row_id)
+	for (row_id, delay), value in zip([row for row in rows if row[1] > 0], values):
+		# 设置缓存值并更新调度时间; XX 选项保证不会重新调度在此期间被取消的行
+		pipe.set('inv:' + row_id, value)
+		pipe.execute_command('ZADD', 'schedule:', 'XX', now + delay, row_id)
+	pipe.execute()
+	return len(rows)
 
-		# 读取数据行
-		row = Inventory.get(row_id)
-		conn.zadd('schedule:', row_id, now + delay)
-		# 更新调度时间并设置缓存值
-		conn.set('inv:' + row_id, json.dumps(row.to_dict()))
+def cache_rows(conn, workers=8, batch=1000, lease=30):
+	with futures.ThreadPoolExecutor(workers) as pool:
+		while not QUIT:
+			# 暂时没有行需要被缓存, 休息50毫秒后重试
+			if not refresh_rows(conn, pool, batch, lease):
+				time.sleep(.05)
 
 def rescale_viewed(conn):
 	while not QUIT:
@@ -138,12 +521,155 @@ def rescale_viewed(conn):
 		# 5分钟以后再次进行操作
 		time.sleep(300)
 
-def can_cache(conn, request):
+# 开始一次重新归一化: 推进起始时间并记录缩放系数. 已经有重新归一化在进行时
+# 不做任何修改, 返回正在使用的缩放系数, 以便继续完成上一次被中断的缩放
+# KEYS: VIEWED_KEYS  ARGV: 新的起始时间, 缩放系数
+_start_renormalize_script = script_load('''
+local factor = redis.call('get', KEYS[3])
+if factor then
+	return factor
+end
+redis.call('set', KEYS[2], ARGV[1])
+redis.call('set', KEYS[3], ARGV[2])
+redis.call('del', KEYS[4])
+return ARGV[2]
+''')
+
+# 把一批尚未缩放过的商品的分值乘以缩放系数, 并把它们记录到 viewed-rescaled: 里面,
+# 返回这次缩放的商品数量
+# KEYS: VIEWED_KEYS  ARGV: 商品...
+_scale_viewed_script = script_load('''
+local factor = tonumber(redis.call('get', KEYS[3]))
+local scaled = 0
+for i = 1, #ARGV do
+	if redis.call('sadd', KEYS[4], ARGV[i]) == 1 then
+		local score = redis.call('zscore', KEYS[1], ARGV[i])
+		if score then
+			redis.call('zadd', KEYS[1], tonumber(score) * factor, ARGV[i])
+			scaled = scaled + 1
+		end
+	end
+end
+return scaled
+''')
+
+def start_renormalize(conn, now=None):
+	# 权重增长得过大时, 把权重的起始时间向前推进整数个半衰期. 返回真值表示有一次
+	# 重新归一化正在进行(可能是之前被中断的那一次), 需要继续缩放已有的分值
+	now = now or time.time()
+	if conn.exists('viewed-rescale:'):
+		return True
+	epoch = float(conn.get('viewed-epoch:') or now)
+	shift = int((now - epoch) / DECAY_HALF_LIFE)
+	if shift < RENORMALIZE_EXPONENT:
+		return False
+	_start_renormalize_script(conn, VIEWED_KEYS,
+		[epoch + shift * DECAY_HALF_LIFE, 2 ** -shift])
+	return True
+
+def renormalize_viewed(conn, chunk=1000, now=None):
+	# 推进权重的起始时间, 然后分批把已有的分值缩小相应的倍数, 返回被缩放的商品数量.
+	# ZSCAN 可能会重复返回同一个商品, 并发的浏览也可能已经缩放过某个商品,
+	# 脚本通过 viewed-rescaled: 保证每个商品只被缩放一次
+	if not start_renormalize(conn, now):
+		return 0
+	scaled = 0
+	for members in _scan_chunks(conn, 'viewed:', chunk):
+		if members:
+			scaled += _scale_viewed_script(conn, VIEWED_KEYS, members)
+	# 所有商品都已经缩放完毕, 结束这次重新归一化
+	conn.delete('viewed-rescale:', 'viewed-rescaled:')
+	return scaled
+
+def _scan_chunks(conn, key, chunk):
+	cursor = '0'
+	while True:
+		cursor, items = conn.zscan(key, cursor, count=chunk)
+		yield [member for member, score in items]
+		if not int(cursor):
+			break
+
+def trim_viewed(conn, keep=20000, chunk=1000):
+	# 分批删除浏览次数最少的商品, 每次只删除 chunk 个, 避免长时间阻塞Redis.
+	# 分值越小(负数绝对值越大)的商品浏览次数越多, 所以从排名 keep 开始往后删除
+	removed = 0
+	while not QUIT:
+		count = conn.zremrangebyrank('viewed:', keep, keep + chunk - 1)
+		removed += count
+		if count < chunk:
+			break
+	return removed
+
+def maintain_decayed_viewed(conn, keep=20000, chunk=1000):
+	# 衰减模式下用来代替 rescale_viewed() 的后台任务
+	while not QUIT:
+		trim_viewed(conn, keep, chunk)
+		renormalize_viewed(conn, chunk)
+		time.sleep(300)
+
+class CacheableIndex(object):
+	# 每个工作进程在本地保存一份浏览次数排名前 size 位的商品ID快照,
+	# 由后台线程定期使用一次 ZRANGE 刷新, can_cache() 可以直接在内存里面回答
+	def __init__(self, conn, size=10000, interval=1):
+		self.conn = conn
+		self.size = size
+		self.interval = interval
+		self.items = frozenset()
+		self.refreshed = 0
+		self.refresh_latency = 0
+		self.refreshes = 0
+		# 刷新失败的次数以及最近一次的异常, 刷新失败时继续使用旧的快照,
+		# 调用者可以通过 staleness() 和这两个属性发现快照已经停止更新
+		self.errors = 0
+		self.last_error = None
+		self.stopped = False
+
+	def refresh(self):
+		start = time.time()
+		# 浏览次数越多的商品分值越小, 所以排名最前面的商品位于有序集合的开头
+		items = self.conn.zrange('viewed:', 0, self.size - 1)
+		# 直接替换整个快照, 读取快照的线程不需要加锁
+		self.items = frozenset(item.decode() for item in items)
+		self.refreshed = time.time()
+		self.refresh_latency = self.refreshed - start
+		self.refreshes += 1
+
+	def staleness(self):
+		# 快照距离上次刷新已经过去的秒数
+		return time.time() - self.refreshed
+
+	def __contains__(self, item_id):
+		return item_id in self.items
+
+	def run(self):
+		while not QUIT and not self.stopped:
+			try:
+				self.refresh()
+			except Exception as error:
+				# 刷新线程不能因为一次连接错误而退出, 否则快照会被永久冻结
+				self.errors += 1
+				self.last_error = error
+			time.sleep(self.interval)
+
+	def start(self):
+		self.refresh()
+		t = threading.Thread(target=self.run)
+		t.daemon = True
+		t.start()
+		return t
+
+	def stop(self):
+		self.stopped = True
+
+def can_cache(conn, request, index=None):
 	# 尝试从页面里面取出商品ID
 	item_id = extract_item_id(request)
 	# 检查这个页面能否被缓存一级这个页面是否为商品页面
 	if not item_id or is_dynamic(request):
 		return False
+	# 有本地索引的时候, 不需要向Redis发送任何命令
+	if index is not None:
+		return item_id in index
 	# 取得商品的浏览次数排名
 	rank = conn.zrank('viewed:', item_id)
 	# 根据商品的浏览次数排名来判断是否需要缓存这个页面
@@ -151,6 +677,19 @@ def can_cache(conn, request):
 
 #--------------- 以下是用于测试代码的辅助函数 --------------------------------
 
+def benchmark_cache_request(conn, requests=10000, local=None, items=100):
+	# 反复请求一组热门商品页面, 返回每秒处理的请求数量
+	def callback(request):
+		return 'content for ' + request + ' ' * 10000
+	urls = ['http://test.com/?item=item%s' % i for i in range(items)]
+	for i in range(items):
+		conn.zadd('viewed:', 'item%s' % i, -1)
+
+	start = time.time()
+	for i in range(requests):
+		cache_request(conn, urls[i % items], callback, local)
+	return requests / (time.time() - start)
+
 def extract_item_id(request):
 	parsed = parse.urlparse(request)
 	query = parse.parse_qs(parsed.query)
@@ -161,8 +700,50 @@ def is_dynamic(request):
 	query = parse.parse_qs(parsed.query)
 	return '_' in query
 
-def hash_request(request):
-	return str(hash(request))
+# 只用于统计流量来源, 不会影响页面内容的查询参数
+TRACKING_PARAMS = set([
+	'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+	'gclid', 'fbclid',
+])
+
+def normalize_request(request, vary=None):
+	# 把同一个页面的不同写法规范化成同一个字符串: 主机名小写, 去掉片段和跟踪参数,
+	# 并对查询参数进行排序; vary 给定时, 只有其中列出的参数和防缓存参数 _ 会影响缓存
+	parsed = parse.urlsplit(request)
+	params = parse.parse_qsl(parsed.query, keep_blank_values=True)
+	if vary is not None:
+		params = [(k, v) for k, v in params if k in vary or k == '_']
+	else:
+		params = [(k, v) for k, v in params if k not in TRACKING_PARAMS]
+	return parse.urlunsplit((parsed.scheme.lower(), parsed.netloc.lower(),
+		parsed.path or '/', parse.urlencode(sorted(params)), ''))
+
+def hash_request(request, vary=None):
+	# 内置的 hash() 在每个进程里面都使用不同的随机种子, 会让每个工作进程
+	# 都写入自己的缓存键; 这里使用稳定的摘要, 所有进程都会得到相同的键
+	return hashlib.blake2b(normalize_request(request, vary).encode('utf-8'),
+		digest_size=16).hexdigest()
+
+def benchmark_hit_rate(requests=10000, workers=8, items=100, seed=0):
+	# 模拟多个工作进程处理同一批商品页面请求, 比较按进程随机的键和稳定指纹的命中率.
+	# 请求里面的参数顺序和跟踪参数是随机的
+	rand = random.Random(seed)
+	seen = {'per_process': set(), 'fingerprint': set()}
+	hits = {'per_process': 0, 'fingerprint': 0}
+	for i in range(requests):
+		params = [('item', 'item%s' % rand.randrange(items)), ('page', '1')]
+		if rand.random() < .5:
+			params.append(('utm_source', rand.choice(['mail', 'ads', 'social'])))
+		rand.shuffle(params)
+		url = 'http://test.com/?' + parse.urlencode(params)
+		worker = rand.randrange(workers)
+		for name, key in (
+				('per_process', (worker, url)),
+				('fingerprint', hash_request(url))):
+			if key in seen[name]:
+				hits[name] += 1
+			seen[name].add(key)
+	return dict((name, hits[name] / float(requests)) for name in hits)
 
 class Inventory(object):
 	def __init__(self, id):
@@ -186,13 +767,14 @@ class TestCh02(unittest.TestCase):
 		to_del = (
 			conn.keys("login:*") + conn.keys("recent:*") + conn.keys('viewed:*') +
 			conn.keys('cart:*') + conn.keys('cache:*') + conn.keys('delay:*') +
-			conn.keys('schedule:*') + conn.keys('inv:*'))
+			conn.keys('schedule:*') + conn.keys('inv:*') + conn.keys('session:*'))
 		if to_del:
 			self.conn.delete(*to_del)
 		del self.conn
 		global QUIT, LIMIT
 		QUIT = False
 		LIMIT = 10000000
+		REAPER_STATS.update({'reaped': 0, 'backlog': 0, 'rate': 0.0})
 		print()
 		print()
 
@@ -223,7 +805,7 @@ class TestCh02(unittest.TestCase):
 		QUIT = True
 		time.sleep(2)
 
-		if t.isAlive():
+		if t.is_alive():
 			raise Exception("The clean sessions thread is still alive?!?")
 
 		s = conn.hlen('login:')
@@ -253,7 +835,7 @@ class TestCh02(unittest.TestCase):
 		time.sleep(1)
 		QUIT = True
 		time.sleep(2)
-		if t.isAlive():
+		if t.is_alive():
 			raise Exception("The clean sessions thread is still alive?!?")
 
 		r = conn.hgetall('cart:' + token)
@@ -261,6 +843,61 @@ class TestCh02(unittest.TestCase):
 
 		self.assertFalse(r)
 
+	def test_adaptive_reaper(self):
+		conn = self.conn
+		global LIMIT, QUIT, REAP_MAX_BATCH
+
+		print("Let's create 5000 sessions and drop the limit to 100")
+		pipe = conn.pipeline(False)
+		for i in range(5000):
+			pipe.hset('login:', 'token%s' % i, 'user%s' % i)
+			pipe.zadd('recent:', 'token%s' % i, i)
+			pipe.zadd('viewed:token%s' % i, 'itemX', i)
+			pipe.hset('cart:token%s' % i, 'itemY', 1)
+		pipe.execute()
+
+		LIMIT = 100
+		old_batch = REAP_MAX_BATCH
+		REAP_MAX_BATCH = 1000
+		try:
+			t = threading.Thread(target=clean_full_sessions, args=(conn,))
+			t.setDaemon(1)
+			t.start()
+			time.sleep(1.5)
+			QUIT = True
+			t.join()
+		finally:
+			REAP_MAX_BATCH = old_batch
+		print("Reaper stats:", REAPER_STATS)
+		self.assertEqual(conn.zcard('recent:'), 100)
+		self.assertEqual(conn.hlen('login:'), 100)
+		self.assertEqual(REAPER_STATS['reaped'], 4900)
+		self.assertEqual(REAPER_STATS['backlog'], 0)
+		self.assertFalse(conn.exists('cart:token0'))
+		self.assertTrue(conn.exists('cart:token4999'))
+
+	def test_cart_operations(self):
+		conn = self.conn
+		anonymous = str(uuid.uuid4())
+		token = str(uuid.uuid4())
+
+		print("Updating several items in one round trip")
+		add_to_cart(conn, token, 'itemX', 1)
+		add_to_cart(conn, token, 'itemX', 0)
+		self.assertFalse(conn.exists('cart:' + token))
+		r = update_cart(conn, token, {'itemX': 2, 'itemY': 1, 'itemZ': 0})
+		print(r)
+		self.assertEqual(r, {b'itemX': b'2', b'itemY': b'1'})
+		r = update_cart(conn, token, {'itemY': 0, 'itemZ': 4})
+		self.assertEqual(r, {b'itemX': b'2', b'itemZ': b'4'})
+
+		print("Merging an anonymous cart into the logged-in cart, capped at 5 per item")
+		update_cart(conn, anonymous, {'itemX': 1, 'itemZ': 3})
+		r = merge_carts(conn, anonymous, token, cap=5)
+		print(r)
+		self.assertEqual(r, {b'itemX': b'3', b'itemZ': b'5'})
+		self.assertFalse(conn.exists('cart:' + anonymous))
+
 	def test_cache_request(self):
 		conn = self.conn
 		token = str(uuid.uuid4())
@@ -286,6 +923,239 @@ class TestCh02(unittest.TestCase):
 		self.assertFalse(can_cache(conn, "http://test.com/"))
 		self.assertFalse(can_cache(conn, 'http://test.com/?item=itemX&_=1234536'))
 
+	def test_local_page_cache(self):
+		conn = self.conn
+		token = str(uuid.uuid4())
+
+		def callback(request):
+			return "content for " + request
+
+		update_token(conn, token, 'username', 'itemX')
+		url = 'http://test.com/?item=itemX'
+		local = LocalPageCache(max_bytes=100, ttl=1)
+		result = cache_request(conn, url, callback, local)
+		print("The page is stored compressed in Redis:",
+			repr(conn.get('cache:' + hash_request(url))))
+		self.assertEqual(zlib.decompress(conn.get('cache:' + hash_request(url))), result.encode())
+
+		print("A second request is served from the local cache without touching Redis")
+		conn.delete('viewed:')
+		self.assertEqual(cache_request(conn, url, None, local), result)
+		self.assertEqual(local.stats['hits'], 1)
+
+		print("Requests with the cache-buster parameter always call the callback")
+		dynamic = url + '&_=999'
+		self.assertEqual(cache_request(conn, dynamic, callback, local, vary=['item']),
+			callback(dynamic))
+		self.assertEqual(local.stats['hits'], 1)
+
+		print("Once the local copy expires we fall back to the compressed Redis copy")
+		update_token(conn, token, 'username', 'itemX')
+		time.sleep(1.1)
+		self.assertEqual(cache_request(conn, url, None, local), result.encode())
+		self.assertEqual(local.stats['expired'], 1)
+
+		print("Pages over the byte budget push out the least recently used ones")
+		local.set('a', 'x' * 60)
+		local.set('b', 'x' * 60)
+		self.assertEqual(local.get('a'), None)
+		self.assertEqual(local.get('cache:' + hash_request(url)), None)
+		self.assertEqual(local.stats['evictions'], 2)
+		print(local.stats)
+
+		print("Requests/sec with and without the local cache:")
+		print("redis only:", benchmark_cache_request(conn, 2000))
+		print("local + redis:", benchmark_cache_request(conn, 2000, LocalPageCache()))
+
+	def test_refresh_rows(self):
+		conn = self.conn
+
+		print("Scheduling 2000 rows and refreshing them with two competing refreshers")
+		pipe = conn.pipeline(False)
+		for i in range(2000):
+			pipe.zadd('delay:', 'row%s' % i, 60)
+			pipe.zadd('schedule:', 'row%s' % i, time.time())
+		pipe.execute()
+		schedule_row_cache(conn, 'row0', -1)
+		conn.set('inv:row0', 'stale')
+
+		counts = []
+		def refresher():
+			with futures.ThreadPoolExecutor(4) as pool:
+				counts.append(refresh_rows(conn, pool, batch=5000))
+		threads = [threading.Thread(target=refresher) for i in range(2)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		print("Rows handled by each refresher:", counts)
+		self.assertEqual(sum(counts), 2000)
+		self.assertEqual(len(conn.keys('inv:*')), 1999)
+		self.assertFalse(conn.exists('inv:row0'))
+		self.assertEqual(conn.zscore('schedule:', 'row0'), None)
+		self.assertTrue(conn.zscore('schedule:', 'row1') > time.time() + 50)
+		self.assertEqual(json.loads(conn.get('inv:row1').decode())['id'], 'row1')
+
+	def test_decayed_viewed(self):
+		conn = self.conn
+		token = str(uuid.uuid4())
+
+		print("Recent views count for more than old ones in decayed mode")
+		now = time.time()
+		conn.set('viewed-epoch:', now - 2 * DECAY_HALF_LIFE)
+		update_token(conn, token, 'username', 'itemX', decay=True)
+		self.assertAlmostEqual(conn.zscore('viewed:', 'itemX'), -4, places=2)
+		for item in ('itemX', 'itemY', 'itemY'):
+			record_view(conn, item, now + DECAY_HALF_LIFE)
+		self.assertEqual(conn.zrange('viewed:', 0, -1), [b'itemY', b'itemX'])
+
+		print("Renormalization shrinks every score without changing the order")
+		for i in range(50):
+			conn.zadd('viewed:', 'item%s' % i, -i)
+		scores = dict(conn.zrange('viewed:', 0, -1, withscores=True))
+		later = now + RENORMALIZE_EXPONENT * DECAY_HALF_LIFE
+		self.assertEqual(renormalize_viewed(conn, chunk=10, now=later), 52)
+		factor = 2 ** -(RENORMALIZE_EXPONENT + 2)
+		for member, score in conn.zrange('viewed:', 0, -1, withscores=True):
+			self.assertAlmostEqual(score / factor, scores[member])
+		self.assertAlmostEqual(float(conn.get('viewed-epoch:')), later)
+		self.assertEqual(renormalize_viewed(conn, now=later), 0)
+		self.assertFalse(conn.exists('viewed-rescale:') or conn.exists('viewed-rescaled:'))
+		print("Views recorded after renormalization use the new epoch right away")
+		before = conn.zscore('viewed:', 'item10')
+		self.assertAlmostEqual(record_view(conn, 'item10', later), before - 1)
+
+		print("Views recorded while a renormalization is in progress are kept")
+		scores = dict(conn.zrange('viewed:', 0, -1, withscores=True))
+		latest = later + RENORMALIZE_EXPONENT * DECAY_HALF_LIFE
+		self.assertTrue(start_renormalize(conn, latest))
+		factor = 2 ** -RENORMALIZE_EXPONENT
+		self.assertAlmostEqual(record_view(conn, 'item10', latest), scores[b'item10'] * factor - 1)
+		update_packed_token(conn, token, 'username', 'item11', decay=True)
+		self.assertEqual(renormalize_viewed(conn, chunk=10, now=latest), 50)
+		self.assertAlmostEqual(conn.zscore('viewed:', 'item10'), scores[b'item10'] * factor - 1)
+		self.assertTrue(conn.zscore('viewed:', 'item11') < scores[b'item11'] * factor)
+		self.assertAlmostEqual(conn.zscore('viewed:', 'item12'), scores[b'item12'] * factor)
+		conn.delete('session:' + token)
+
+		print("Trimming removes the least viewed items in bounded chunks")
+		self.assertEqual(trim_viewed(conn, keep=20, chunk=7), 32)
+		self.assertEqual(conn.zcard('viewed:'), 20)
+		self.assertEqual(conn.zscore('viewed:', 'item1'), None)
+		self.assertTrue(conn.zscore('viewed:', 'item49'))
+		conn.delete('viewed-epoch:')
+
+	def test_cacheable_index(self):
+		conn = self.conn
+
+		for i in range(5):
+			conn.zadd('viewed:', 'item%s' % i, -i)
+		index = CacheableIndex(conn, size=3, interval=.1)
+		index.start()
+		print("The local index holds the 3 most viewed items:", sorted(index.items))
+		self.assertTrue(can_cache(conn, 'http://test.com/?item=item4', index))
+		self.assertFalse(can_cache(conn, 'http://test.com/?item=item1', index))
+		self.assertFalse(can_cache(conn, 'http://test.com/?item=item4&_=1234', index))
+
+		conn.zadd('viewed:', 'item1', -10)
+		time.sleep(.3)
+		print("After a background refresh:", sorted(index.items))
+		print("Refreshes: %s, staleness: %.3fs, refresh latency: %.4fs" % (
+			index.refreshes, index.staleness(), index.refresh_latency))
+		self.assertTrue(can_cache(conn, 'http://test.com/?item=item1', index))
+		self.assertTrue(index.refreshes > 1)
+		self.assertTrue(index.staleness() < .3)
+
+		print("Refresh errors are counted and the thread keeps running")
+		index.conn = redis.Redis(port=1, db=15)
+		time.sleep(.3)
+		self.assertTrue(index.errors > 0)
+		self.assertTrue(isinstance(index.last_error, redis.exceptions.ConnectionError))
+		refreshes = index.refreshes
+		index.conn = conn
+		time.sleep(.3)
+		self.assertTrue(index.refreshes > refreshes)
+		self.assertTrue(can_cache(conn, 'http://test.com/?item=item1', index))
+		index.stop()
+
+	def test_request_fingerprint(self):
+		url = 'http://Test.com/?item=itemX&page=2&utm_source=mail#top'
+		same = 'http://test.com/?page=2&item=itemX'
+		self.assertEqual(hash_request(url), hash_request(same))
+		self.assertNotEqual(hash_request(url), hash_request('http://test.com/?item=itemX&page=3'))
+		self.assertEqual(hash_request(url, vary=['item']),
+			hash_request('http://test.com/?item=itemX&page=3', vary=['item']))
+		self.assertNotEqual(hash_request(url, vary=['item']),
+			hash_request('http://test.com/?item=itemX&_=999', vary=['item']))
+
+		print("Every process computes the same cache key for the same request:")
+		keys = set()
+		for seed in ('1', '2', '3'):
+			env = dict(os.environ, PYTHONHASHSEED=seed)
+			keys.add(subprocess.check_output([sys.executable, '-c',
+				'import runpy, sys; print(runpy.run_path(sys.argv[1])["hash_request"](sys.argv[2]))',
+				os.path.abspath(__file__), url], env=env).strip())
+		print(keys)
+		self.assertEqual(keys, set([hash_request(url).encode()]))
+
+		print("Hit rates for per-process keys and stable fingerprints across 8 workers:")
+		rates = benchmark_hit_rate()
+		print(rates)
+		self.assertTrue(rates['fingerprint'] > rates['per_process'])
+
+	def test_packed_sessions(self):
+		conn = self.conn
+		global LIMIT, QUIT
+		token = str(uuid.uuid4())
+
+		print("Keeping a whole session in one compact hash")
+		for i in range(SESSION_VIEWED_LIMIT + 5):
+			update_packed_token(conn, token, 'username', 'item%s' % i)
+		add_to_packed_cart(conn, token, 'itemY', 3)
+		add_to_packed_cart(conn, token, 'itemZ', 1)
+		add_to_packed_cart(conn, token, 'itemZ', 0)
+		session = get_packed_session(conn, token)
+		print(session)
+		self.assertEqual(check_packed_token(conn, token), b'username')
+		self.assertEqual(len(session['viewed']), SESSION_VIEWED_LIMIT)
+		self.assertEqual(session['viewed'][0], 'item%s' % (SESSION_VIEWED_LIMIT + 4))
+		self.assertEqual(session['cart'], {'itemY': 3})
+		self.assertEqual(conn.object('encoding', 'session:' + token) in (b'ziplist', b'listpack'), True)
+
+		print("Migrating an existing session to the compact layout")
+		old = str(uuid.uuid4())
+		update_token(conn, old, 'other_user', 'itemX')
+		add_to_cart(conn, old, 'itemY', 2)
+		self.assertEqual(migrate_sessions(conn), 1)
+		self.assertFalse(conn.exists('viewed:' + old) or conn.exists('cart:' + old))
+		session = get_packed_session(conn, old)
+		self.assertEqual(session['user'], b'other_user')
+		self.assertEqual(session['viewed'], ['itemX'])
+		self.assertEqual(session['cart'], {'itemY': 2})
+
+		print("Reaping removes the whole session hash")
+		LIMIT = 0
+		t = threading.Thread(target=clean_packed_sessions, args=(conn,))
+		t.daemon = True
+		t.start()
+		time.sleep(.5)
+		QUIT = True
+		t.join()
+		self.assertFalse(conn.exists('session:' + token))
+
+		QUIT = False
+		print("Memory per session, original and compact layout:")
+		conn.hset('login:', 'live', 'username')
+		conn.zadd('recent:', 'live', 1)
+		report = session_memory_report(conn, sessions=2000)
+		print(report)
+		self.assertTrue(report['packed'] < report['original'])
+		# 报告不会修改线上的会话
+		self.assertEqual(conn.hget('login:', 'live'), b'username')
+		self.assertEqual(conn.zcard('recent:'), 1)
+		self.assertFalse(conn.exists('session:live'))
+		self.assertEqual(conn.keys('memory-report:*'), [])
+
 	def test_cache_row(self):
 		import pprint
 		conn = self.conn
@@ -329,7 +1199,7 @@ class TestCh02(unittest.TestCase):
 
 		QUIT = True
 		time.sleep(2)
-		if t.isAlive():
+		if t.is_alive():
 			raise Exception("The database caching thread is still alive?!?")
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-import time, threading, redis
+import json, queue, time, threading, redis
 
 conn = redis.Redis(db=15)
 def publisher(n):
@@ -31,4 +31,207 @@ def run_pubsub():
 		if count == 5:
 			break
 
-run_pubsub()
\ No newline at end of file
+class BatchSubscriber(object):
+	# 可复用的订阅者: 读取线程成批地取出消息, 放进有界队列, 再由工作线程池调用
+	# handler(messages) 处理. 队列满的时候读取线程会阻塞, 不再从连接里面读取消息,
+	# 以此对处理速度跟不上的情况施加背压(积压的消息会留在Redis的客户端输出缓冲区里面,
+	# 超过 client-output-buffer-limit 时连接会被断开, 之后由重连逻辑恢复订阅)
+	def __init__(self, conn, channels, handler, batch_size=100, workers=4,
+			max_pending=100, reconnect_delay=.1):
+		self.conn = conn
+		self.channels = list(channels)
+		self.handler = handler
+		self.batch_size = batch_size
+		self.workers = workers
+		self.reconnect_delay = reconnect_delay
+		self.queue = queue.Queue(max_pending)
+		self.running = False
+		self.threads = []
+		self.lock = threading.Lock()
+		# lag 是最近一批消息从被读取到开始处理所等待的秒数
+		self.stats = {'received': 0, 'handled': 0, 'batches': 0,
+			'reconnects': 0, 'errors': 0, 'lag': 0.0, 'max_lag': 0.0}
+
+	def start(self):
+		self.running = True
+		self.pubsub = self._subscribe()
+		self.threads = [threading.Thread(target=self._read)]
+		self.threads.extend(
+			threading.Thread(target=self._work) for i in range(self.workers))
+		for t in self.threads:
+			t.daemon = True
+			t.start()
+		return self
+
+	def stop(self):
+		self.running = False
+		for t in self.threads:
+			t.join()
+		self.pubsub.close()
+
+	def pending(self):
+		# 队列里面等待处理的批次数量
+		return self.queue.qsize()
+
+	def _subscribe(self):
+		pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+		pubsub.subscribe(self.channels)
+		return pubsub
+
+	def _read(self):
+		delay = self.reconnect_delay
+		while self.running:
+			try:
+				message = self.pubsub.get_message(timeout=.1)
+				if message is None:
+					continue
+				# 把已经到达的消息一次性取完, 组成一个批次
+				batch = [message]
+				while len(batch) < self.batch_size:
+					message = self.pubsub.get_message()
+					if message is None:
+						break
+					batch.append(message)
+				delay = self.reconnect_delay
+			except redis.exceptions.ConnectionError:
+				# 连接断开之后, 使用指数退避进行重连, 并重新订阅所有频道
+				self.stats['reconnects'] += 1
+				# 先关闭旧的订阅连接, 避免每次重连都泄漏一个连接
+				try:
+					self.pubsub.close()
+				except redis.exceptions.RedisError:
+					pass
+				time.sleep(delay)
+				delay = min(delay * 2, 5)
+				try:
+					self.pubsub = self._subscribe()
+				except redis.exceptions.ConnectionError:
+					pass
+				continue
+
+			with self.lock:
+				self.stats['received'] += len(batch)
+			# 队列已满时在这里阻塞, 从而对读取施加背压
+			item = (time.time(), batch)
+			while self.running:
+				try:
+					self.queue.put(item, timeout=.1)
+					break
+				except queue.Full:
+					continue
+
+	def _work(self):
+		while self.running or not self.queue.empty():
+			try:
+				received, batch = self.queue.get(timeout=.1)
+			except queue.Empty:
+				continue
+			lag = time.time() - received
+			try:
+				self.handler(batch)
+			except Exception:
+				with self.lock:
+					self.stats['errors'] += 1
+			with self.lock:
+				self.stats['handled'] += len(batch)
+				self.stats['batches'] += 1
+				self.stats['lag'] = lag
+				self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+
+class BatchPublisher(object):
+	# 把要发布的消息缓存在内存里面, 每凑满 batch_size 条或者每隔 interval 秒,
+	# 就通过一个流水线一次性地发布出去
+	def __init__(self, conn, batch_size=100, interval=.01):
+		self.conn = conn
+		self.batch_size = batch_size
+		self.interval = interval
+		self.buffer = []
+		self.lock = threading.Lock()
+		# 同一时间只允许一个线程发送缓存的消息, 保证同一频道的消息按发布顺序到达
+		self.flush_lock = threading.Lock()
+		# 发布失败的次数和最近一次的异常
+		self.errors = 0
+		self.last_error = None
+		self.running = True
+		self.thread = threading.Thread(target=self._flusher)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def publish(self, channel, message):
+		with self.lock:
+			self.buffer.append((channel, message))
+			full = len(self.buffer) >= self.batch_size
+		if full:
+			self.flush()
+
+	def flush(self):
+		# 发布缓存的消息, 成功时返回真值. 发布失败时把这一批消息放回缓存的最前面,
+		# 等待下一次刷新时重试, 而不是把异常抛给调用者并丢掉这些消息
+		with self.flush_lock:
+			with self.lock:
+				buffer, self.buffer = self.buffer, []
+			if not buffer:
+				return True
+			try:
+				pipe = self.conn.pipeline(False)
+				for channel, message in buffer:
+					pipe.publish(channel, message)
+				pipe.execute()
+			except Exception as error:
+				with self.lock:
+					self.buffer[:0] = buffer
+				self.errors += 1
+				self.last_error = error
+				return False
+			return True
+
+	def close(self):
+		# 停止后台线程, 并把剩下的消息全部发布出去; 发布失败时返回假值,
+		# 没有发布的消息仍然留在 buffer 里面
+		self.running = False
+		self.thread.join()
+		return self.flush()
+
+	def _flusher(self):
+		while self.running:
+			time.sleep(self.interval)
+			self.flush()
+
+def benchmark_pubsub(conn, channels=1, messages=10000):
+	# 使用批量发布者和批量订阅者在 channels 个频道上传递 messages 条消息,
+	# 每条消息都带有发布时间, 返回每秒传递的消息数量以及端到端延迟的p50/p99(毫秒)
+	names = ['bench:%s' % i for i in range(channels)]
+	latencies = []
+	done = threading.Event()
+
+	def handler(batch):
+		now = time.time()
+		latencies.extend(now - float(message['data']) for message in batch)
+		if len(latencies) >= messages:
+			done.set()
+
+	subscriber = BatchSubscriber(conn, names, handler).start()
+	batch_publisher = BatchPublisher(conn)
+	start = time.time()
+	for i in range(messages):
+		batch_publisher.publish(names[i % channels], repr(time.time()))
+	batch_publisher.close()
+	done.wait(30)
+	duration = time.time() - start
+	subscriber.stop()
+
+	latencies.sort()
+	def percentile(p):
+		return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0
+	return {
+		'channels': channels,
+		'received': len(latencies),
+		'messages/sec': len(latencies) / duration,
+		'p50': percentile(.5),
+		'p99': percentile(.99),
+	}
+
+if __name__ == '__main__':
+	run_pubsub()
+	for channels in (1, 10, 100):
+		print(json.dumps(benchmark_pubsub(conn, channels)))
@@ -0,0 +1,155 @@
+import multiprocessing
+import threading
+import time
+import redis
+
+def script_load(script):
+	sha = [None]
+	def call(conn, keys=[], args=[], force_eval=False):
+		if not force_eval:
+			if not sha[0]:
+				# 如果脚本尚未被载入, 那么先载入它
+				sha[0] = conn.execute_command(
+					'SCRIPT', 'LOAD', script, parse='LOAD')
+			try:
+				return conn.execute_command(
+					'EVALSHA', sha[0], len(keys), *(keys+args))
+			except redis.exceptions.ResponseError as msg:
+				# 只有在服务器丢失了脚本缓存的情况下才会重新发送整个脚本
+				if not msg.args[0].startswith('NOSCRIPT'):
+					raise
+		return conn.execute_command(
+			'EVAL', script, len(keys), *(keys+args))
+	return call
+
+# 对同一个计数器执行"读取-加一-写回"操作的几种并发策略的基准测试.
+# chapter-4.py 和 chapter-5.py 只演示了命令交错的现象, 这里用数据来比较它们:
+# 每种策略都执行同样的 GET 然后 SET value+1 的工作, 只是保护读取和写回的方式不同.
+# 每种策略在 M 个进程 × N 个线程下运行, 统计每秒操作数、延迟的p50/p99、
+# WATCH 重试次数, 以及计数器的最终值是否等于实际执行的操作数量
+
+COUNTER = 'bench:counter'
+
+def unpipelined(conn, pipe):
+	# 不使用事务: 读取和写回之间可能插入其他客户端的写入, 导致更新丢失
+	value = int(conn.get(COUNTER) or 0)
+	conn.set(COUNTER, value + 1)
+	return 0
+
+def multi_exec(conn, pipe):
+	# 只把写回放在 MULTI/EXEC 事务里面: 事务保证其中的命令不会被打断,
+	# 但是读取发生在事务之外, 没有 WATCH 的话仍然会丢失更新
+	value = int(conn.get(COUNTER) or 0)
+	pipe.set(COUNTER, value + 1)
+	pipe.execute()
+	return 0
+
+def watch_retry(conn, pipe):
+	# 使用 WATCH 实现乐观锁, 在计数器被其他客户端修改时进行重试
+	retries = 0
+	while True:
+		try:
+			pipe.watch(COUNTER)
+			value = int(pipe.get(COUNTER) or 0)
+			pipe.multi()
+			pipe.set(COUNTER, value + 1)
+			pipe.execute()
+			return retries
+		except redis.exceptions.WatchError:
+			retries += 1
+
+_incr_script = script_load('''
+local value = tonumber(redis.call('get', KEYS[1]) or '0')
+redis.call('set', KEYS[1], value + 1)
+return value + 1
+''')
+
+def scripted(conn, pipe):
+	# 把读取和写回放在同一个Lua脚本里面, 脚本执行期间不会有其他命令插入
+	_incr_script(conn, [COUNTER])
+	return 0
+
+STRATEGIES = {
+	'unpipelined': unpipelined,
+	'multi_exec': multi_exec,
+	'watch_retry': watch_retry,
+	'scripted': scripted,
+}
+
+def _run_threads(strategy, threads, ops):
+	# 在当前进程里面启动 threads 个线程, 每个线程执行 ops 次操作
+	conn = redis.Redis(db=15)
+	function = STRATEGIES[strategy]
+	latencies = []
+	retries = [0]
+	lock = threading.Lock()
+
+	def worker():
+		pipe = conn.pipeline(True)
+		local = []
+		local_retries = 0
+		for i in range(ops):
+			start = time.time()
+			local_retries += function(conn, pipe)
+			local.append(time.time() - start)
+		with lock:
+			latencies.extend(local)
+			retries[0] += local_retries
+
+	workers = [threading.Thread(target=worker) for i in range(threads)]
+	for t in workers:
+		t.start()
+	for t in workers:
+		t.join()
+	return latencies, retries[0]
+
+def _run_process(strategy, threads, ops, results):
+	results.put(_run_threads(strategy, threads, ops))
+
+def run_benchmark(strategy, threads=4, processes=1, ops=1000):
+	conn = redis.Redis(db=15)
+	conn.delete(COUNTER)
+
+	start = time.time()
+	if processes == 1:
+		runs = [_run_threads(strategy, threads, ops)]
+	else:
+		# 每个进程都会创建自己的Redis连接
+		results = multiprocessing.Queue()
+		children = [multiprocessing.Process(
+			target=_run_process, args=(strategy, threads, ops, results))
+			for i in range(processes)]
+		for child in children:
+			child.start()
+		runs = [results.get() for child in children]
+		for child in children:
+			child.join()
+	duration = time.time() - start
+
+	latencies = sorted(latency for run in runs for latency in run[0])
+	def percentile(p):
+		return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+	expected = processes * threads * ops
+	final = int(conn.get(COUNTER) or 0)
+	conn.delete(COUNTER)
+	return {
+		'strategy': strategy,
+		'processes': processes,
+		'threads': threads,
+		'ops/sec': expected / duration,
+		'p50': percentile(.5),
+		'p99': percentile(.99),
+		'retries': sum(run[1] for run in runs),
+		'final': final,
+		'expected': expected,
+		'correct': final == expected,
+	}
+
+if __name__ == '__main__':
+	for processes in (1, 4):
+		for threads in (1, 8):
+			for strategy in ('unpipelined', 'multi_exec', 'watch_retry', 'scripted'):
+				result = run_benchmark(strategy, threads, processes, ops=500)
+				print('%(strategy)-12s M=%(processes)s N=%(threads)-2s '
+					'%(ops/sec)8.0f ops/sec  p50=%(p50).3fms  p99=%(p99).3fms  '
+					'retries=%(retries)-6s final=%(final)s/%(expected)s' % result)
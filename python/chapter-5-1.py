@@ -1,12 +1,18 @@
 
+import array
+import atexit
+import binascii
 import bisect
+import collections
 import contextlib
 import csv
 from datetime import datetime
 import functools
 import json
 import logging
+import os
 import random
+import struct
 import threading
 import time
 import unittest
@@ -48,6 +54,162 @@ def log_recent(conn, name, message, severity=logging.INFO, pipe=None):
 	# 执行两个命令
 	pipe.execute()
 
+# 当前进程里面所有的后台刷新器, 进程退出和 fork 时统一处理
+_FLUSHERS = []
+
+class BackgroundFlusher(object):
+	# 后台刷新线程的公共实现: 后台线程每隔 interval 秒, 或者在 _should_flush() 为真
+	# 时被 wake() 提前唤醒, 调用子类的 flush(). flush() 失败时应该先把取出的数据放回去
+	# 再抛出异常; 后台线程会把Redis错误记录在 stats['errors'] 和 last_error 里面,
+	# 等待 interval 秒之后重试, 而不会退出. fork 出来的子进程会在其他线程出现之前
+	# 丢弃从父进程继承的数据(它们由父进程负责写入)并重新启动仍在运行的后台线程.
+	# close() 或者进程退出时会停止后台线程并做最后一次 flush()
+	def __init__(self, interval):
+		self.interval = interval
+		self.stats = {'flushes': 0, 'errors': 0}
+		self.last_error = None
+		self._start()
+		_FLUSHERS.append(self)
+
+	def _start(self):
+		self.pid = os.getpid()
+		self.condition = threading.Condition()
+		self.running = True
+		self._reset()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _reset(self):
+		# 子类在这里创建需要刷新的数据
+		pass
+
+	def _should_flush(self):
+		return False
+
+	def wake(self):
+		with self.condition:
+			self.condition.notify_all()
+
+	def flush(self):
+		raise NotImplementedError
+
+	def _try_flush(self):
+		try:
+			self.flush()
+			return True
+		except redis.exceptions.RedisError as error:
+			self.stats['errors'] += 1
+			self.last_error = error
+			return False
+
+	def close(self):
+		# 停止后台线程并写入剩余的数据. 关闭之后的刷新器不再需要在 fork 和
+		# 进程退出时处理, 把它从 _FLUSHERS 里面移除
+		if self.pid != os.getpid():
+			return
+		if self in _FLUSHERS:
+			_FLUSHERS.remove(self)
+		if self.running:
+			with self.condition:
+				self.running = False
+				self.condition.notify_all()
+			self.thread.join()
+		self._try_flush()
+
+	def _run(self):
+		while self.running:
+			with self.condition:
+				if self.running and not self._should_flush():
+					self.condition.wait(self.interval)
+			if not self._try_flush():
+				# 出错之后等待一段时间再重试, 避免在Redis不可用时空转
+				with self.condition:
+					if self.running:
+						self.condition.wait(self.interval)
+
+def _restart_flushers():
+	for flusher in _FLUSHERS:
+		if flusher.running:
+			flusher._start()
+
+def _close_flushers():
+	# close() 会修改 _FLUSHERS, 所以遍历它的副本
+	for flusher in list(_FLUSHERS):
+		flusher.close()
+
+atexit.register(_close_flushers)
+os.register_at_fork(after_in_child=_restart_flushers)
+
+class LogShipper(BackgroundFlusher):
+	# 缓冲的日志发送器: log() 只是把日志记录追加到内存队列里面, 由后台线程每隔
+	# flush_interval 秒或者每积累 flush_size 条记录, 就通过一个流水线一次性地写入Redis,
+	# 并且每个目标列表只执行一次 LTRIM. 队列满时, overflow 为 'drop' 会丢弃新的记录,
+	# 为 'block' 会阻塞调用者直到队列有空位, 但最多等待 block_timeout 秒, 超时之后
+	# 同样丢弃记录. 写入失败的记录会被放回队列的前面, 放不下的记录计入 dropped
+	def __init__(self, conn, flush_interval=.1, flush_size=1000,
+			max_queue=100000, overflow='drop', block_timeout=1):
+		self.conn = conn
+		self.flush_size = flush_size
+		self.max_queue = max_queue
+		self.overflow = overflow
+		self.block_timeout = block_timeout
+		BackgroundFlusher.__init__(self, flush_interval)
+		self.stats.update({'logged': 0, 'dropped': 0})
+
+	def _reset(self):
+		self.records = collections.deque()
+
+	def _should_flush(self):
+		return len(self.records) >= self.flush_size
+
+	def log(self, name, message, severity=logging.INFO):
+		severity = str(SEVERITY.get(severity, severity)).lower()
+		destination = 'recent:%s:%s' % (name, severity)
+		message = time.asctime() + ' ' + message
+		deadline = time.time() + self.block_timeout
+		with self.condition:
+			while len(self.records) >= self.max_queue:
+				remaining = deadline - time.time()
+				if self.overflow == 'drop' or not self.running or remaining <= 0:
+					self.stats['dropped'] += 1
+					return False
+				# 阻塞模式下等待后台线程腾出空位
+				self.condition.wait(remaining)
+			self.records.append((destination, message))
+			self.stats['logged'] += 1
+			if len(self.records) >= self.flush_size:
+				self.condition.notify_all()
+		return True
+
+	def flush(self):
+		with self.condition:
+			records = self.records
+			self.records = collections.deque()
+			self.condition.notify_all()
+		if not records:
+			return 0
+		# 把同一个目标的消息合并成一个 LPUSH, 并且只修剪一次列表
+		grouped = collections.OrderedDict()
+		for destination, message in records:
+			grouped.setdefault(destination, []).append(message)
+		pipe = self.conn.pipeline(False)
+		for destination, messages in grouped.items():
+			pipe.lpush(destination, *messages[-100:])
+			pipe.ltrim(destination, 0, 99)
+		try:
+			pipe.execute()
+		except redis.exceptions.RedisError:
+			# 把记录按原来的顺序放回队列的前面, 队列放不下的旧记录被丢弃
+			with self.condition:
+				space = max(self.max_queue - len(self.records), 0)
+				kept = list(records)[-space:] if space else []
+				self.records.extendleft(reversed(kept))
+				self.stats['dropped'] += len(records) - len(kept)
+			raise
+		self.stats['flushes'] += 1
+		return len(records)
+
 def log_common(conn, name, message, severity=logging.INFO, timeout=5):
 	# 设置日志的安全级别
 	severity = str(SEVERITY.get(severity, severity)).lower()
@@ -66,8 +228,9 @@ def log_common(conn, name, message, severity=logging.INFO, timeout=5):
 			# 取得当前所处的小时数
 			hour_start = datetime(*now[:4]).isoformat()
 
-			# 取得当前所处的小时数
-			existing = str(pipe.get(start_key))
+			# 取得当前所处的小时数(键不存在时为None, 不能直接转换为字符串)
+			existing = pipe.get(start_key)
+			existing = existing and existing.decode()
 			# 创建一个事务
 			pipe.multi()
 
@@ -82,24 +245,76 @@ def log_common(conn, name, message, severity=logging.INFO, timeout=5):
 				pipe.set(start_key, hour_start)
 			# 对记录日志出现次数的计数器执行自增操作
 			pipe.zincrby(destination, message)
-			# log_recent() 函数负责记录日志并调用execute()函数
-			log_recent(pipe, name, message, severity, pipe)
+			# log_recent() 函数把近期日志的命令也放进这个事务里面, 并调用execute()函数
+			log_recent(conn, name, message, severity, pipe)
 			return
 		except redis.exceptions.WatchError:
 			# 如果程序因为其他客户端正在执行归档操作而出现监视错误， 那么进行重试
 			continue
 
+# 按小时分桶的常见日志保留的小时数
+COMMON_HOURS = 3
+
+def hour_bucket(hours_ago=0, now=None):
+	# 返回 hours_ago 小时之前所处的小时, 格式与 log_common() 记录的小时数相同
+	now = (now or time.time()) - hours_ago * 3600
+	return time.strftime('%Y-%m-%dT%H', time.gmtime(now))
+
+def log_common_bucketed(conn, name, message, severity=logging.INFO, pipe=None):
+	# 不需要轮换的常见日志: 每个小时的日志写入以小时命名的键里面, 并且让键自动过期,
+	# 所以写入路径上不需要 WATCH, 也不会因为其他客户端的写入而重试
+	severity = str(SEVERITY.get(severity, severity)).lower()
+	destination = 'common:%s:%s:%s' % (name, severity, hour_bucket())
+	pipe = pipe or conn.pipeline()
+	pipe.zincrby(destination, message)
+	pipe.expire(destination, COMMON_HOURS * 3600)
+	log_recent(conn, name, message, severity, pipe)
+
+def get_common(conn, name, severity=logging.INFO, hours_ago=0):
+	# 读取当前(hours_ago=0)、上一个(hours_ago=1)或者最近任意一个小时的常见日志
+	severity = str(SEVERITY.get(severity, severity)).lower()
+	destination = 'common:%s:%s:%s' % (name, severity, hour_bucket(hours_ago))
+	return conn.zrevrange(destination, 0, -1, withscores=True)
+
+def benchmark_log_common(conn, function, writers=32, logs=200):
+	# 让 writers 个线程同时向同一个常见日志写入, 返回每秒写入的日志数量
+	def writer():
+		for i in range(logs):
+			function(conn, 'bench', 'message-%s' % (i % 10))
+	threads = [threading.Thread(target=writer) for i in range(writers)]
+	start = time.time()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return writers * logs / (time.time() - start)
+
 # 以秒为单位的计数器经度，分别为1秒、5秒、1分钟、5分钟、1小时、5小时、一天
 # 用户可以按需调整这些精度
 PRECISION = [1, 5, 60, 300, 3600, 18000, 86400]
+# 汇总模式下, 除了最细的精度之外还会直接写入的精度
+ROLLUP_HOT = [5]
+# 汇总程序只汇总至少在这么多秒之前的样本, 给延迟到达的写入留出时间.
+# 汇总程序的落后时间必须小于最细精度的样本保留时间(SAMPLE_COUNT秒), 否则
+# 尚未汇总的样本会被 clean_counters() 清理掉
+ROLLUP_DELAY = 5
 
-def update_counter(conn, name, count = 1, now = None):
+def update_counter(conn, name, count = 1, now = None, rollup = False):
 	# 通过取得当前时间来判断应该对哪个时间片执行自增操作
 	now = now or time.time()
 	# 为了保证之后的清理工作可以正确地执行，这里需要创建一个事务型流水线
 	pipe = conn.pipeline()
+	precisions = PRECISION
+	if rollup:
+		# 汇总模式下只写入最细的精度和 ROLLUP_HOT 里面的精度, 其他精度由
+		# rollup_counters() 在后台汇总. 第一次写入时记录汇总的起点
+		precisions = [PRECISION[0]] + ROLLUP_HOT
+		pipe.set('rolled:' + name, int(now / PRECISION[0]) * PRECISION[0], nx=True)
+		# 空闲的计数器会被移出 rollup:, 并且汇总进度会被设置过期时间, 重新写入时恢复
+		pipe.persist('rolled:' + name)
+		pipe.zadd('rollup:', name, 0)
 	# 为我们记录的每一种精度都创建一个计数器
-	for prec in PRECISION:
+	for prec in precisions:
 		# 取得当前时间片的开始时间
 		pnow = int(now / prec) * prec
 		# 创建负责存储技术信息的散列
@@ -111,91 +326,497 @@ def update_counter(conn, name, count = 1, now = None):
 		pipe.hincrby('count:' + hash, pnow, count)
 	pipe.execute()
 
+class CounterAggregator(BackgroundFlusher):
+	# 进程内的计数器预聚合: update() 只在本地按照 (计数器, 时间片) 累加增量,
+	# 后台线程每隔 interval 秒把所有增量通过一个流水线写入Redis, 所以计数器
+	# 在Redis里面最多落后 interval 秒(加上一次写入的时间). 写入失败的增量会被合并
+	# 回本地, 在下一次写入时重试. 已经登记到 known: 里面的计数器不会重复登记;
+	# 因为 clean_counters() 可能会移除空的计数器, 本地记录每隔 known_ttl 秒清空一次
+	def __init__(self, conn, interval=1, known_ttl=300):
+		self.conn = conn
+		self.known_ttl = known_ttl
+		BackgroundFlusher.__init__(self, interval)
+
+	def _reset(self):
+		self.pending = collections.defaultdict(int)
+		self.known = set()
+		self.known_reset = time.time()
+
+	def update(self, name, count=1, now=None):
+		now = now or time.time()
+		with self.condition:
+			for prec in PRECISION:
+				pnow = int(now / prec) * prec
+				self.pending['%s:%s' % (prec, name), pnow] += count
+
+	def flush(self):
+		with self.condition:
+			pending, self.pending = self.pending, collections.defaultdict(int)
+		if not pending:
+			return 0
+		if time.time() - self.known_reset > self.known_ttl:
+			self.known = set()
+			self.known_reset = time.time()
+
+		pipe = self.conn.pipeline()
+		new = set(hash for hash, pnow in pending) - self.known
+		for hash in new:
+			pipe.zadd('known:', hash, 0)
+		for (hash, pnow), count in pending.items():
+			pipe.hincrby('count:' + hash, pnow, count)
+		try:
+			pipe.execute()
+		except redis.exceptions.RedisError:
+			# 事务没有执行, 把增量合并回本地, 在下一次写入时重试
+			with self.condition:
+				for key, count in pending.items():
+					self.pending[key] += count
+			raise
+		self.known.update(new)
+		self.stats['flushes'] += 1
+		return len(pending)
+
+def benchmark_update_counter(conn, updates=10000, names=10):
+	# 比较直接调用 update_counter() 和使用本地预聚合时, 每秒能够处理的计数器更新数量
+	results = {}
+	start = time.time()
+	for i in range(updates):
+		update_counter(conn, 'bench%s' % (i % names))
+	results['update_counter'] = updates / (time.time() - start)
+
+	aggregator = CounterAggregator(conn)
+	start = time.time()
+	for i in range(updates):
+		aggregator.update('bench%s' % (i % names))
+	aggregator.close()
+	results['aggregator'] = updates / (time.time() - start)
+	return results
+
+# 载入Lua脚本, 并返回一个在调用时会优先使用 EVALSHA 执行脚本的函数
+def script_load(script):
+	sha = [None]
+	def call(conn, keys=[], args=[], force_eval=False):
+		if not force_eval:
+			if not sha[0]:
+				# 如果脚本尚未被载入, 那么先载入它
+				sha[0] = conn.execute_command(
+					'SCRIPT', 'LOAD', script, parse='LOAD')
+			try:
+				return conn.execute_command(
+					'EVALSHA', sha[0], len(keys), *(keys+args))
+			except redis.exceptions.ResponseError as msg:
+				# 只有在服务器丢失了脚本缓存的情况下才会重新发送整个脚本
+				if not msg.args[0].startswith('NOSCRIPT'):
+					raise
+		return conn.execute_command(
+			'EVAL', script, len(keys), *(keys+args))
+	return call
+
+def is_rolled_up(precision):
+	# 汇总模式的计数器只有在这些精度上需要合并尚未汇总的样本
+	return precision != PRECISION[0] and precision not in ROLLUP_HOT
+
+# 读取较粗精度的计数器, 同时合并尚未汇总的最细精度样本. 只有存在 rolled:<名字> 的
+# 计数器(汇总模式)才会读取最细精度的样本, 并且只读取从汇总进度到窗口结束之间的
+# 时间片; 窗口比散列里面的样本还多时才退回到 HGETALL. 所有读取都在同一个脚本里面
+# 完成, 汇总程序不会在读取之间推进汇总进度.
+# KEYS: 每个计数器的 count:<精度>:<名字>, rolled:<名字>, count:<最细精度>:<名字>
+# ARGV: 精度, 最细精度, 窗口开始时间(为空时读取整个较粗精度的散列), 窗口结束时间
+# 返回: 每个计数器的较粗精度数据(HMGET 的结果或者 HGETALL 的结果),
+#       以及尚未汇总的 (时间片, 计数值) 扁平列表
+_read_counters_script = script_load('''
+local prec, fine = tonumber(ARGV[1]), tonumber(ARGV[2])
+local start, finish = tonumber(ARGV[3]), tonumber(ARGV[4])
+local function hmget(key, first, last, step)
+	-- 分批执行 HMGET, 避免 unpack() 的参数过多
+	local values = {}
+	for from = first, last, step * 1000 do
+		local fields = {}
+		for slice = from, math.min(last, from + step * 999), step do
+			fields[#fields + 1] = string.format('%d', slice)
+		end
+		for _, value in ipairs(redis.call('hmget', key, unpack(fields))) do
+			values[#values + 1] = value
+		end
+	end
+	return values
+end
+local result = {}
+for c = 1, #KEYS, 3 do
+	if start then
+		result[#result + 1] = hmget(KEYS[c], start, finish, prec)
+	else
+		result[#result + 1] = redis.call('hgetall', KEYS[c])
+	end
+	local unrolled = {}
+	local rolled = redis.call('get', KEYS[c + 1])
+	if rolled then
+		local first = math.max(tonumber(rolled), start or 0)
+		local last = finish + prec - fine
+		local counts = {}
+		local function add(slice, value)
+			if value and slice >= first and slice <= last then
+				local pnow = math.floor(slice / prec) * prec
+				counts[pnow] = (counts[pnow] or 0) + tonumber(value)
+			end
+		end
+		if last >= first then
+			if (last - first) / fine < redis.call('hlen', KEYS[c + 2]) then
+				for i, value in ipairs(hmget(KEYS[c + 2], first, last, fine)) do
+					add(first + (i - 1) * fine, value)
+				end
+			else
+				local data = redis.call('hgetall', KEYS[c + 2])
+				for i = 1, #data, 2 do
+					add(tonumber(data[i]), data[i + 1])
+				end
+			end
+		end
+		for pnow, count in pairs(counts) do
+			unrolled[#unrolled + 1] = string.format('%d', pnow)
+			unrolled[#unrolled + 1] = string.format('%d', count)
+		end
+	end
+	result[#result + 1] = unrolled
+end
+return result
+''')
+
+def _read_counter_keys(names, precision):
+	keys = []
+	for name in names:
+		keys.extend(['count:%s:%s' % (precision, name), 'rolled:' + name,
+			'count:%s:%s' % (PRECISION[0], name)])
+	return keys
+
 def get_counter(conn, name, precision):
 	# 取得存储计数器数据的键的名字
 	hash = '%s:%s' % (precision, name)
 	# 从Redis里面取出计数器数据
-	data = conn.hgetall('count:' + hash)
+	counts = collections.defaultdict(int)
+	if not is_rolled_up(precision):
+		data = conn.hgetall('count:' + hash)
+	else:
+		# 对于汇总模式的计数器, 还需要合并尚未汇总的最细精度样本
+		data, unrolled = _read_counters_script(conn, _read_counter_keys([name], precision),
+			[precision, PRECISION[0], '', int(time.time() / precision) * precision])
+		data = dict(zip(data[::2], data[1::2]))
+		for key, value in zip(unrolled[::2], unrolled[1::2]):
+			counts[int(key)] += int(value)
+	for key, value in data.items():
+		counts[int(key)] += int(value)
 	to_return = []
 	# 将计数器数据转换成指定的格式
-	for key, value in data.items():
-		to_return.append((int(key), int(value)))
+	for key, value in counts.items():
+		to_return.append((key, value))
 	# 对数据进行排序，把旧的数据样本排在前面
 	to_return.sort()
 	return to_return 
 
-def clean_counters(conn):
-	pipe = conn.pipeline(True)
-	# 为了平等地处理更新频率各不相同的多个计数器，
-	# 程序需要记录清理操作执行的次数。
-	passes = 0
+def get_counters(conn, names, precision, start=None, end=None):
+	# 用一个流水线取出多个计数器在 [start, end] 时间窗口内的数据. 只读取窗口内的
+	# 时间片, 缺失的时间片用0填充. 返回时间片开始时间的列表, 以及计数器名字到
+	# 与之对齐的整数数组(array)的字典
+	end = int((end or time.time()) / precision) * precision
+	if start is None:
+		start = end - (SAMPLE_COUNT - 1) * precision
+	start = int(start / precision) * precision
+	slices = list(range(start, end + 1, precision))
+	if not slices:
+		return slices, dict((name, array.array('q')) for name in names)
 
-	# 持续地对计数器进行清理，直到退出为止。
-	while not QUIT:
-		# 记录清理操作开始执行的时间，这个值将被用于计算清理操作的执行时长。
-		start = time.time
-		# 渐进地遍历所有已知的计数器。
-		index = 0
-		while index < conn.zcard('known:'):
-			# 取得被检查计数器的数据。
-			hash = conn.zrange('known:', index, index)
-			index += 1
-			if not hash:
-				break
-			hash = hash[0].decode('utf-8')
-			print(hash)
-			# 取得计数器的精度
-			prec = int(hash.partition(':')[0])
+	if not is_rolled_up(precision):
+		pipe = conn.pipeline(False)
+		for name in names:
+			pipe.hmget('count:%s:%s' % (precision, name), slices)
+		results = [(values, []) for values in pipe.execute()]
+	else:
+		# 汇总模式的计数器还需要合并窗口内尚未汇总的最细精度样本, 与 get_counter() 相同
+		results = _read_counters_script(conn, _read_counter_keys(names, precision),
+			[precision, PRECISION[0], start, end])
+		results = list(zip(results[::2], results[1::2]))
+	counters = {}
+	for name, (values, unrolled) in zip(names, results):
+		counter = counters[name] = array.array('q', (int(value or 0) for value in values))
+		for pnow, count in zip(unrolled[::2], unrolled[1::2]):
+			counter[(int(pnow) - start) // precision] += int(count)
+	return slices, counters
+
+def benchmark_get_counters(conn, counters=500, precision=60):
+	# 比较逐个调用 get_counter() 和调用一次 get_counters() 读取 counters 个
+	# 各有 SAMPLE_COUNT 个样本的计数器所需的秒数
+	names = ['bench%s' % i for i in range(counters)]
+	end = int(time.time() / precision) * precision
+	pipe = conn.pipeline(False)
+	for name in names:
+		pipe.hmset('count:%s:%s' % (precision, name), dict(
+			(end - i * precision, i) for i in range(SAMPLE_COUNT)))
+	pipe.execute()
+
+	results = {}
+	start = time.time()
+	for name in names:
+		get_counter(conn, name, precision)
+	results['get_counter'] = time.time() - start
+	start = time.time()
+	get_counters(conn, names, precision, end=end)
+	results['get_counters'] = time.time() - start
+	conn.delete(*['count:%s:%s' % (precision, name) for name in names])
+	return results
+
+# 每个分页从 known: 里面取出的计数器数量
+CLEAN_PAGE_SIZE = 1000
+# 清理程序最近一次完成的清理操作的运行指标: 执行时长、检查的计数器数量、
+# 移除的样本数量以及移除的计数器数量
+CLEANER_STATS = {'passes': 0, 'duration': 0.0, 'counters': 0, 'trimmed': 0, 'removed': 0}
+
+def counter_shard(hash, shards):
+	# 根据计数器名字的CRC32校验和把计数器分配到 shards 个分片之一
+	if isinstance(hash, str):
+		hash = hash.encode('utf-8')
+	return binascii.crc32(hash) % shards
 
-			# 因为清理程序每60秒就会循环一次， 所以这里需要根据计数器的更新频率
-			# 来判断是否真的有必要对计数器进行清理。
-			bprec = int(prec // 60) or 1
+def clean_counters_pass(conn, passes=0, shard=0, shards=1, page=CLEAN_PAGE_SIZE):
+	# 对属于给定分片的计数器执行一次清理. known: 里面所有成员的分值都是0,
+	# 所以可以用 ZRANGEBYLEX 按成员分页遍历: 即使遍历期间有计数器被移除,
+	# 下一页的起点也不会发生偏移
+	stats = {'counters': 0, 'trimmed': 0, 'removed': 0}
+	now = time.time()
+	last = '-'
+	pipe = conn.pipeline(False)
+	while True:
+		hashes = conn.zrangebylex('known:', last, '+', 0, page)
+		if not hashes:
+			break
+		last = b'(' + hashes[-1]
 
-			# 如果这个计数器在这次循环里不需要进行清理，那么检查下一个计数器。（
-			# 举个例子，如果清理程序只循环了3次，而计数器的更新频率为每5分钟一次，
-			# 那么程序暂时还不需要对这个计数器进行清理。
-			if passes % bprec:
+		checks = []
+		for hash in hashes:
+			if shards > 1 and counter_shard(hash, shards) != shard:
 				continue
+			hash = hash.decode('utf-8')
+			prec = int(hash.partition(':')[0])
+			# 清理程序每60秒执行一次清理, 更新频率较低的计数器不需要每次都清理
+			if passes % (prec // 60 or 1):
+				continue
+			checks.append((hash, now - SAMPLE_COUNT * prec))
+		if not checks:
+			continue
 
-			hkey = 'count:' + hash
-			# 根据给定的精度以及需要保留的样本数量，计算出我们需要保留什么时间
-			# 之前的样本
-			cutoff = time.time - SAMPLE_COUNT * prec
-			#  获取样本的开始时间，并将其从字符串转为整数
-			samples = map(int, conn.hkeys(hkey))
-			samples = sorted(samples)
+		# 用一个流水线取出这一页所有计数器的样本时间, 再用另一个流水线移除过期样本
+		for hash, cutoff in checks:
+			pipe.hkeys('count:' + hash)
+		emptied = []
+		for (hash, cutoff), samples in zip(checks, pipe.execute()):
+			samples = sorted(map(int, samples))
 			remove = bisect.bisect_right(samples, cutoff)
-			# 按需移除技术样本
 			if remove:
-				conn.hdel(hkey, *samples[:remove])
-				# 这个散列可能已经被清空
+				pipe.hdel('count:' + hash, *samples[:remove])
+				stats['trimmed'] += remove
 				if remove == len(samples):
-					try:
-						# 在尝试修改计数器三列之前, 对其进行监视.
-						pipe.watch(hkey)
-						# 验证计数器散列是否为空, 如果是的话, 那么从记录
-						# 一直计数器的有序集合里面移除它. 计数器散列并不
-						# 为空, 继续让他留在记录一直计数器的有序集合里面
-						if not pipe.hlen(hkey):
-							pipe.multi()
-							pipe.zrem('known:', hash)
-							pipe.execute()
-							# 在删除一个计数器的情况下, 下次循环可以使用
-							# 与本次循环相同的索引
-							index -= 1
-						else:
-							pipe.unwatch()
-					except redis.exceptions.WatchError:
-						pass
-
-		# 为了让清理操作的执行频率与计数器更新的频率保持一致, 
-		# 对记录循环次数的变量以及记录执行时长的变量进行更新
+					emptied.append(hash)
+		pipe.execute()
+		stats['counters'] += len(checks)
+
+		# 计数器散列可能已经被清空, 这时使用 WATCH 确认它在此期间没有被
+		# 写入新的样本, 然后再把它从 known: 里面移除
+		for hash in emptied:
+			with conn.pipeline(True) as trans:
+				try:
+					trans.watch('count:' + hash)
+					if not trans.hlen('count:' + hash):
+						trans.multi()
+						trans.zrem('known:', hash)
+						trans.execute()
+						stats['removed'] += 1
+				except redis.exceptions.WatchError:
+					pass
+
+	stats['duration'] = time.time() - now
+	return stats
+
+def clean_counters(conn, shard=0, shards=1, page=CLEAN_PAGE_SIZE):
+	# 持续地清理属于给定分片的计数器, 直到退出为止. 启动 shards 个清理进程,
+	# 并分别传入 0 到 shards-1 作为 shard, 就可以让它们分担全部计数器的清理工作
+	passes = 0
+	while not QUIT:
+		stats = clean_counters_pass(conn, passes, shard, shards, page)
 		passes += 1
-		duration = min(int(time.time - start) + 1, 60)
-		# 如果这次循环未耗尽60秒, 那么在余下的时间内进行休眠;
-		# 如果60秒已经耗尽,那么休眠一秒以便稍作休息
-		time.sleep(max(60 - duration, 1))
+		stats['passes'] = passes
+		CLEANER_STATS.update(stats)
+		logging.info("counter cleaner shard %s/%s: checked %s counters, "
+			"trimmed %s samples, removed %s counters in %.3fs", shard, shards,
+			stats['counters'], stats['trimmed'], stats['removed'], stats['duration'])
+
+		# 如果这次清理未耗尽60秒, 那么在余下的时间内进行休眠;
+		# 如果60秒已经耗尽, 那么休眠一秒以便稍作休息
+		deadline = time.time() + max(60 - stats['duration'], 1)
+		while not QUIT and time.time() < deadline:
+			time.sleep(.1)
+
+
+
+# 环形缓冲区计数器: 每个 (名字, 精度) 计数器是一个字符串 ring:<精度>:<名字>,
+# 由 RING_SLOTS 个定长的槽组成. 时间片 pnow 存放在第 (pnow/精度) % RING_SLOTS
+# 个槽里面, 每个槽包含一个32位无符号的时间片编号 pnow/精度 和一个64位有符号的
+# 计数值. 写入时如果槽里面的编号与当前时间片不同, 说明槽里面保存的是一圈之前的
+# 旧样本, 直接覆盖即可, 所以这种计数器不需要 clean_counters() 清理, 也不需要
+# 登记到 known: 里面. 整个字符串在 RING_SLOTS 个时间片之后过期
+RING_SLOTS = 100
+RING_SLOT_FORMAT = struct.Struct('>Iq')
+
+_update_ring_script = script_load('''
+local count = ARGV[1]
+local size = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+	local tag = tonumber(ARGV[3*i])
+	local offset = tonumber(ARGV[3*i+1]) * 96
+	if redis.call('exists', key) == 0 then
+		-- 一次性分配整个环形缓冲区, 让计数器占用的内存保持固定
+		redis.call('setrange', key, size - 1, '\\0')
+	end
+	if redis.call('bitfield', key, 'GET', 'u32', offset)[1] == tag then
+		redis.call('bitfield', key, 'INCRBY', 'i64', offset + 32, count)
+	else
+		redis.call('bitfield', key, 'SET', 'u32', offset, tag,
+			'SET', 'i64', offset + 32, count)
+	end
+	redis.call('expire', key, ARGV[3*i+2])
+end
+''')
+
+def update_ring_counter(conn, name, count=1, now=None):
+	# 与 update_counter() 相同, 但是把数据写入环形缓冲区计数器
+	now = now or time.time()
+	keys = []
+	args = [count, RING_SLOTS * RING_SLOT_FORMAT.size]
+	for prec in PRECISION:
+		index = int(now / prec)
+		keys.append('ring:%s:%s' % (prec, name))
+		args.extend([index, index % RING_SLOTS, RING_SLOTS * prec])
+	_update_ring_script(conn, keys, args)
+
+def get_ring_counter(conn, name, precision, now=None):
+	# 与 get_counter() 相同, 返回按时间排序的 (时间片开始时间, 计数值) 列表.
+	# 只有编号落在最近 RING_SLOTS 个时间片之内的槽才是有效的样本
+	data = conn.getrange('ring:%s:%s' % (precision, name), 0, -1)
+	current = int((now or time.time()) / precision)
+	to_return = []
+	for tag, count in RING_SLOT_FORMAT.iter_unpack(data):
+		if current - RING_SLOTS < tag <= current:
+			to_return.append((tag * precision, count))
+	to_return.sort()
+	return to_return
 
+def benchmark_ring_counter(conn, counters=10):
+	# 对 counters 个计数器, 在每种精度下都写入最近 RING_SLOTS 个时间片的样本,
+	# 比较散列计数器(只保留最近 RING_SLOTS 个样本之后)和环形缓冲区计数器每秒的
+	# 更新次数以及占用的内存. 基准测试只使用自己生成的计数器名字, 只测量和删除
+	# 这些计数器的键, 不会影响其他计数器
+	now = time.time()
+	times = [now - i * prec for prec in PRECISION for i in range(RING_SLOTS)]
+	names = ['benchmark-ring-%s-%s' % (uuid.uuid4(), i) for i in range(counters)]
+	results = {}
+	for backend, update, prefix in (
+			('hash', update_counter, 'count:'),
+			('ring', update_ring_counter, 'ring:')):
+		keys = [prefix + '%s:%s' % (prec, name) for name in names for prec in PRECISION]
+		start = time.time()
+		for name in names:
+			for when in times:
+				update(conn, name, now=when)
+		rate = counters * len(times) / (time.time() - start)
+		if backend == 'hash':
+			# update_counter() 会把计数器登记到 known: 里面, 只移除这里登记的成员
+			conn.zrem('known:', *['%s:%s' % (prec, name) for name in names for prec in PRECISION])
+			# 与环形缓冲区一样, 每个散列只保留最近 RING_SLOTS 个时间片的样本
+			for prec in PRECISION:
+				cutoff = (int(now / prec) - RING_SLOTS + 1) * prec
+				for name in names:
+					key = 'count:%s:%s' % (prec, name)
+					old = [slice for slice in conn.hkeys(key) if int(slice) < cutoff]
+					if old:
+						conn.hdel(key, *old)
+		memory = sum(conn.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0) or 0
+			for key in keys)
+		results[backend] = {'updates/sec': rate, 'bytes/counter': memory / counters}
+		conn.delete(*keys)
+	return results
+
+
+# 每次汇总脚本处理的计数器数量, 脚本执行期间会阻塞Redis, 所以不宜过大
+ROLLUP_PAGE_SIZE = 100
+
+# 对一页计数器, 把 [rolled:<名字>, 截止时间) 之间的最细精度样本累加到较粗的精度
+# 里面, 然后把汇总进度推进到截止时间. 没有比截止时间更新的样本的计数器处于空闲
+# 状态, 会被移出 rollup:, 它的汇总进度会在最细精度的样本被清理之后过期.
+# 较粗精度的键名是在脚本里面拼出来的
+# KEYS: rollup:, 以及每个计数器的 count:<最细精度>:<名字>, rolled:<名字>
+# ARGV: 截止时间, 汇总进度的空闲过期时间, 精度的数量, 需要汇总的各个精度, 各个计数器的名字
+_rollup_script = script_load('''
+local finish = tonumber(ARGV[1])
+local precisions = tonumber(ARGV[3])
+local rolled = 0
+for c = 1, (#KEYS - 1) / 2 do
+	local fine, mark = KEYS[2 * c], KEYS[2 * c + 1]
+	local name = ARGV[3 + precisions + c]
+	local start = tonumber(redis.call('get', mark) or finish)
+	local data = redis.call('hgetall', fine)
+	local pending = false
+	for i = 1, #data, 2 do
+		local slice = tonumber(data[i])
+		if slice >= finish then
+			pending = true
+		elseif slice >= start then
+			rolled = rolled + 1
+			for j = 4, 3 + precisions do
+				local prec = tonumber(ARGV[j])
+				local hash = prec .. ':' .. name
+				redis.call('hincrby', 'count:' .. hash,
+					string.format('%d', math.floor(slice / prec) * prec), data[i + 1])
+				redis.call('zadd', 'known:', 0, hash)
+			end
+		end
+	end
+	if start < finish then
+		redis.call('set', mark, finish)
+	end
+	if not pending then
+		redis.call('zrem', KEYS[1], name)
+		redis.call('expire', mark, ARGV[2])
+	end
+end
+return rolled
+''')
+
+def rollup_counters_pass(conn, now=None, page=ROLLUP_PAGE_SIZE):
+	# 对所有汇总模式的计数器执行一次汇总, 每一页计数器只需要调用一次汇总脚本.
+	# 返回检查的计数器数量和汇总的样本数量
+	finish = int(((now or time.time()) - ROLLUP_DELAY) / PRECISION[0]) * PRECISION[0]
+	coarse = [prec for prec in PRECISION[1:] if prec not in ROLLUP_HOT]
+	# 汇总进度至少要保留到已经汇总的最细精度样本被 clean_counters() 清理为止
+	idle_ttl = SAMPLE_COUNT * PRECISION[0] + 60
+	stats = {'counters': 0, 'samples': 0}
+	last = '-'
+	while True:
+		names = conn.zrangebylex('rollup:', last, '+', 0, page)
+		if not names:
+			break
+		last = b'(' + names[-1]
+		names = [name.decode('utf-8') for name in names]
+		keys = ['rollup:']
+		for name in names:
+			keys.extend(['count:%s:%s' % (PRECISION[0], name), 'rolled:' + name])
+		stats['counters'] += len(names)
+		stats['samples'] += _rollup_script(conn, keys,
+			[finish, idle_ttl, len(coarse)] + coarse + names)
+	return stats
+
+def rollup_counters(conn, interval=1):
+	# 持续地汇总计数器, 直到退出为止
+	while not QUIT:
+		rollup_counters_pass(conn)
+		time.sleep(interval)
 
 
 class TestCh05(unittest.TestCase):
@@ -229,6 +850,51 @@ class TestCh05(unittest.TestCase):
 		pprint.pprint(recent[:10])
 		self.assertTrue(len(recent) >= 5)
 
+	def test_log_shipper(self):
+		conn = self.conn
+
+		print("Let's queue a burst of logs and let the shipper flush them in batches")
+		shipper = LogShipper(conn, flush_interval=.05, flush_size=50)
+		for msg in range(120):
+			shipper.log('test', 'this is message %s' % msg, 'error')
+		shipper.log('other', 'this is another message')
+		shipper.close()
+		recent = conn.lrange('recent:test:error', 0, -1)
+		print("Flushes:", shipper.stats['flushes'], "messages kept:", len(recent))
+		self.assertEqual(len(recent), 100)
+		self.assertTrue(recent[0].endswith(b'message 119'))
+		self.assertTrue(recent[-1].endswith(b'message 20'))
+		self.assertEqual(conn.llen('recent:other:20'), 1)
+		self.assertTrue(shipper.stats['flushes'] < 120)
+
+		print("When the queue is full, new records are dropped by default")
+		shipper = LogShipper(conn, flush_interval=10, flush_size=10, max_queue=3)
+		results = [shipper.log('test', 'message %s' % i) for i in range(5)]
+		self.assertEqual(results, [True, True, True, False, False])
+		self.assertEqual(shipper.stats['dropped'], 2)
+		shipper.close()
+
+		self.assertEqual(conn.llen('recent:test:20'), 3)
+
+		print("A failed flush keeps the records and the flusher thread")
+		shipper = LogShipper(redis.Redis(port=1, db=15), flush_interval=.05,
+			max_queue=3, overflow='block', block_timeout=.2)
+		for i in range(3):
+			shipper.log('failing', 'message %s' % i, 'error')
+		time.sleep(.2)
+		self.assertTrue(shipper.stats['errors'] > 0)
+		self.assertTrue(shipper.thread.is_alive())
+		self.assertEqual(len(shipper.records), 3)
+		print("...and a blocked logger gives up after block_timeout")
+		start = time.time()
+		shipper.log('failing', 'blocked', 'error')
+		self.assertTrue(time.time() - start < 1)
+		shipper.conn = conn
+		time.sleep(.3)
+		self.assertEqual(len(shipper.records), 0)
+		self.assertEqual(conn.llen('recent:failing:error'), 3)
+		shipper.close()
+
 	def test_log_common(self):
 		import pprint
 		conn = self.conn
@@ -243,6 +909,170 @@ class TestCh05(unittest.TestCase):
 		pprint.pprint(common)
 		self.assertTrue(len(common) >= 5)
 
+	def test_log_common_bucketed(self):
+		conn = self.conn
+
+		print("Let's write some items to the hourly common log")
+		for count in range(1, 6):
+			for i in range(count):
+				log_common_bucketed(conn, 'test', "message-%s" % count)
+		common = get_common(conn, 'test')
+		print("The current hour has these common messages:", common)
+		self.assertEqual(common[0], (b'message-5', 5.0))
+		self.assertTrue(conn.ttl('common:test:20:' + hour_bucket()) > 0)
+		self.assertEqual(get_common(conn, 'test', hours_ago=1), [])
+		self.assertEqual(len(conn.lrange('recent:test:20', 0, -1)), 15)
+
+		print("Logs/sec with 32 concurrent writers:")
+		print("log_common:", benchmark_log_common(conn, log_common, logs=50))
+		print("log_common_bucketed:", benchmark_log_common(conn, log_common_bucketed, logs=50))
+
+	def test_counter_aggregator(self):
+		conn = self.conn
+
+		print("Let's aggregate counter updates locally and flush them together")
+		aggregator = CounterAggregator(conn, interval=.1)
+		now = time.time()
+		for delta in range(10):
+			aggregator.update('test', count=2, now=now + delta)
+		self.assertEqual(get_counter(conn, 'test', 1), [])
+		time.sleep(.3)
+		counter = get_counter(conn, 'test', 1)
+		self.assertEqual(len(counter), 10)
+		self.assertEqual(sum(count for slice, count in get_counter(conn, 'test', 86400)), 20)
+		self.assertEqual(conn.zcard('known:'), len(PRECISION))
+		self.assertEqual(len(aggregator.known), len(PRECISION))
+
+		aggregator.update('test', count=5, now=now)
+		aggregator.close()
+		self.assertEqual(get_counter(conn, 'test', 1)[0], (int(now), 7))
+		self.assertFalse(aggregator in _FLUSHERS)
+		closed = aggregator
+
+		print("Failed flushes keep the increments and the flusher thread")
+		aggregator = CounterAggregator(redis.Redis(port=1, db=15), interval=.05)
+		aggregator.update('failing', count=3, now=now)
+		time.sleep(.2)
+		self.assertTrue(aggregator.stats['errors'] > 0)
+		self.assertTrue(aggregator.thread.is_alive())
+		aggregator.update('failing', count=4, now=now)
+		aggregator.conn = conn
+		time.sleep(.2)
+		self.assertEqual(get_counter(conn, 'failing', 1), [(int(now), 7)])
+
+		print("A forked child gets its own flusher and does not resend the parent's increments")
+		aggregator.update('forked', now=now)
+		pid = os.fork()
+		if not pid:
+			aggregator.update('forked', count=10, now=now)
+			aggregator.close()
+			# 已经关闭的刷新器不会在子进程里面重新启动
+			restarted = closed.pid == os.getpid() or closed.thread.is_alive()
+			os._exit(0 if aggregator.thread.ident and not restarted else 1)
+		self.assertEqual(os.waitpid(pid, 0)[1], 0)
+		aggregator.close()
+		self.assertEqual(get_counter(conn, 'forked', 1), [(int(now), 11)])
+
+		print("Updates/sec with and without local pre-aggregation:")
+		print(benchmark_update_counter(conn, updates=2000))
+
+	def test_get_counters(self):
+		conn = self.conn
+
+		print("Let's read a 10 second window from several counters at once")
+		now = int(time.time())
+		for delta in (0, 2, 5):
+			update_counter(conn, 'a', count=delta + 1, now=now - delta)
+		update_counter(conn, 'b', now=now - 20)
+		slices, counters = get_counters(conn, ['a', 'b', 'c'], 1, now - 9, now)
+		print(counters)
+		self.assertEqual(slices, list(range(now - 9, now + 1)))
+		self.assertEqual(list(counters['a']), [0, 0, 0, 0, 6, 0, 0, 3, 0, 1])
+		self.assertEqual(list(counters['b']), [0] * 10)
+		self.assertEqual(list(counters['c']), [0] * 10)
+		slices, counters = get_counters(conn, ['b'], 5, end=now)
+		self.assertEqual(len(slices), SAMPLE_COUNT)
+		self.assertEqual(sum(counters['b']), 1)
+
+		print("Seconds to read 500 counters one by one and in one pipeline:")
+		print(benchmark_get_counters(conn))
+
+	def test_ring_counter(self):
+		conn = self.conn
+
+		print("Let's update some ring buffer counters")
+		now = time.time()
+		for delta in range(10):
+			update_ring_counter(conn, 'test', count=delta + 1, now=now + delta)
+		counter = get_ring_counter(conn, 'test', 1, now + 9)
+		print("We have some per-second counters:", counter)
+		self.assertEqual([count for pnow, count in counter], list(range(1, 11)))
+		self.assertEqual(sum(count for pnow, count in get_ring_counter(
+			conn, 'test', 5, now + 9)), 55)
+		self.assertEqual(conn.strlen('ring:1:test'), RING_SLOTS * RING_SLOT_FORMAT.size)
+
+		print("Writing one lap later overwrites the old slots")
+		update_ring_counter(conn, 'test', count=7, now=now + RING_SLOTS)
+		counter = get_ring_counter(conn, 'test', 1, now + RING_SLOTS)
+		self.assertEqual(counter[-1], (int(now) + RING_SLOTS, 7))
+		self.assertEqual(len(counter), 10)
+		self.assertEqual(get_ring_counter(conn, 'test', 1, now + 3 * RING_SLOTS), [])
+		self.assertEqual(get_ring_counter(conn, 'missing', 1), [])
+
+		print("Hash layout vs. ring buffer layout:")
+		update_counter(conn, 'live', now=now - 3600)
+		before = sorted(conn.keys('*'))
+		print(benchmark_ring_counter(conn))
+		print("The benchmark leaves other counters alone")
+		self.assertEqual(sorted(conn.keys('*')), before)
+		self.assertEqual(conn.zcard('known:'), len(PRECISION))
+		self.assertEqual(get_counter(conn, 'live', 1), [(int(now - 3600), 1)])
+
+	def test_rollup_counters(self):
+		conn = self.conn
+
+		print("Let's write some counters that only update the finest precisions")
+		now = int(time.time() / 60) * 60 + 30
+		for delta in range(20):
+			update_counter(conn, 'test', count=delta + 1, now=now - 20 + delta, rollup=True)
+		self.assertFalse(conn.exists('count:60:test'))
+		self.assertEqual(conn.hlen('count:1:test'), 20)
+		expected = [(now - 30, 210)]
+		self.assertEqual(get_counter(conn, 'test', 60), expected)
+
+		print("Rolling up everything older than ROLLUP_DELAY seconds")
+		stats = rollup_counters_pass(conn, now)
+		print(stats)
+		self.assertEqual(stats, {'counters': 1, 'samples': 20 - ROLLUP_DELAY})
+		print(get_counter(conn, 'test', 3600))
+		self.assertEqual(get_counter(conn, 'test', 60), expected)
+		self.assertEqual(sum(count for pnow, count in get_counter(conn, 'test', 86400)), 210)
+		slices, counters = get_counters(conn, ['test'], 60, end=now)
+		self.assertEqual(counters['test'][-1], 210)
+		self.assertEqual(rollup_counters_pass(conn, now)['samples'], 0)
+		self.assertEqual(conn.zcard('rollup:'), 1)
+
+		print("Idle counters leave rollup: once everything is rolled up")
+		self.assertEqual(rollup_counters_pass(conn, now + 60)['samples'], ROLLUP_DELAY)
+		self.assertEqual(get_counter(conn, 'test', 60), expected)
+		self.assertEqual(conn.zcard('rollup:'), 0)
+		self.assertTrue(conn.ttl('rolled:test') > 0)
+		self.assertEqual(rollup_counters_pass(conn, now + 60), {'counters': 0, 'samples': 0})
+		update_counter(conn, 'test', now=now, rollup=True)
+		self.assertEqual(conn.zcard('rollup:'), 1)
+		self.assertEqual(conn.ttl('rolled:test'), None)
+		self.assertTrue(conn.zscore('known:', '86400:test') is not None)
+
+		print("Reads only merge the finest slices inside the window")
+		for delta in range(120):
+			update_counter(conn, 'window', count=delta, now=now - 150 + delta, rollup=True)
+		slices, counters = get_counters(conn, ['window'], 60, now - 90, now - 90)
+		self.assertEqual(list(counters['window']), [sum(range(60, 120))])
+		slices, counters = get_counters(conn, ['window'], 60, now - 210, now - 150)
+		self.assertEqual(list(counters['window']), [0, sum(range(60))])
+		self.assertEqual(get_counter(conn, 'window', 60), [(now - 150, sum(range(60))),
+			(now - 90, sum(range(60, 120)))])
+
 	def test_counters(self):
 		import pprint
 		global QUIT, SAMPLE_COUNT
@@ -265,18 +1095,46 @@ class TestCh05(unittest.TestCase):
 
 		def new_tt():
 			return tt() + 2 * 86400	
-		time.time = new_tt()
+		time.time = new_tt
 
 		print("Let's clean out some counters by setting our sample count to 0")
 		SAMPLE_COUNT = 0
 		t = threading.Thread(target=clean_counters, args=(conn, ))
-		t.setDaemon(1)
+		t.daemon = True
 		t.start()
 		time.sleep(1)
 		QUIT = True
 		time.time = tt
+		t.join()
 		counter =  get_counter(conn, 'test', 86400)
 		print("Did we clean out all of the counters? ", not counter)
+		print("Cleaner stats:", CLEANER_STATS)
+		self.assertFalse(counter)
+		self.assertFalse(conn.zcard('known:'))
+
+	def test_sharded_clean_counters(self):
+		global SAMPLE_COUNT
+		conn = self.conn
+
+		print("Let's split cleaning 200 counters across 3 shards")
+		now = time.time()
+		for i in range(200):
+			update_counter(conn, 'c%s' % i, now=now - 7200)
+			update_counter(conn, 'c%s' % i, now=now)
+		SAMPLE_COUNT = 10
+		total = 0
+		counters = 0
+		for shard in range(3):
+			stats = clean_counters_pass(conn, shard=shard, shards=3, page=64)
+			print(shard, stats)
+			total += stats['trimmed']
+			counters += stats['counters']
+		# 第0次清理会检查所有精度的计数器, 但只有1秒、5秒、1分钟和5分钟精度
+		# 的两小时前的样本超出了保留范围
+		self.assertEqual(counters, 200 * len(PRECISION))
+		self.assertEqual(total, 200 * 4)
+		self.assertEqual(conn.zcard('known:'), 200 * len(PRECISION))
+		self.assertEqual(clean_counters_pass(conn)['trimmed'], 0)
 
 
 if __name__ == '__main__':
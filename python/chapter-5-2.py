@@ -1,11 +1,15 @@
 
+import atexit
 import bisect
+import collections
 import contextlib
 import csv
 from datetime import datetime
 import functools
 import json
 import logging
+import math
+import os
 import random
 import threading
 import time
@@ -28,12 +32,16 @@ def update_stats(conn, context, type, value, timeout=5):
 			now = datetime.utcnow().timetuple()
 			hour_start = datetime(*now[:4]).isoformat()
 
+			# 键不存在时为None, 否则需要先转换为字符串再与 hour_start 比较
 			existing = pipe.get(start_key)
+			existing = existing and existing.decode()
 			pipe.multi()
 			if existing and existing < hour_start:
 				pipe.rename(destination, destination + ':last')
 				pipe.rename(start_key, destination + ':pstart')
 				pipe.set(start_key, hour_start)
+			elif not existing:
+				pipe.set(start_key, hour_start)
 
 			tkey1 = str(uuid.uuid4())
 			tkey2 = str(uuid.uuid4())
@@ -60,9 +68,115 @@ def update_stats(conn, context, type, value, timeout=5):
 			# 如果新的一个小时已经开始， 并且旧的数据已经被归档， 那么进行重试
 			continue
 
-def get_stats(conn, context, type):
+# 载入Lua脚本, 并返回一个在调用时会优先使用 EVALSHA 执行脚本的函数
+def script_load(script):
+	sha = [None]
+	def call(conn, keys=[], args=[], force_eval=False):
+		if not force_eval:
+			if not sha[0]:
+				# 如果脚本尚未被载入, 那么先载入它
+				sha[0] = conn.execute_command(
+					'SCRIPT', 'LOAD', script, parse='LOAD')
+			try:
+				return conn.execute_command(
+					'EVALSHA', sha[0], len(keys), *(keys+args))
+			except redis.exceptions.ResponseError as msg:
+				# 只有在服务器丢失了脚本缓存的情况下才会重新发送整个脚本
+				if not msg.args[0].startswith('NOSCRIPT'):
+					raise
+		return conn.execute_command(
+			'EVAL', script, len(keys), *(keys+args))
+	return call
+
+# 在服务器端完成 update_stats() 的全部工作: 按小时轮换统计数据, 然后用一批样本
+# 更新 min、max、count、sum 和 sumsq. 脚本是原子执行的, 所以不需要临时键和 WATCH
+# KEYS: stats:context:type, 以及它的 :start、:last、:pstart 键
+# ARGV: 当前小时的开始时间, 样本值...
+_update_stats_script = script_load('''
+local existing = redis.call('get', KEYS[2])
+if not existing then
+	redis.call('set', KEYS[2], ARGV[1])
+elseif existing < ARGV[1] then
+	if redis.call('exists', KEYS[1]) == 1 then
+		redis.call('rename', KEYS[1], KEYS[3])
+	end
+	redis.call('rename', KEYS[2], KEYS[4])
+	redis.call('set', KEYS[2], ARGV[1])
+end
+
+local low, high, sum, sumsq = nil, nil, 0, 0
+for i = 2, #ARGV do
+	local value = tonumber(ARGV[i])
+	if not low or value < low then low = value end
+	if not high or value > high then high = value end
+	sum = sum + value
+	sumsq = sumsq + value * value
+end
+if not low then
+	return nil
+end
+
+local current = redis.call('zscore', KEYS[1], 'min')
+if not current or low < tonumber(current) then
+	redis.call('zadd', KEYS[1], string.format('%.17g', low), 'min')
+end
+current = redis.call('zscore', KEYS[1], 'max')
+if not current or high > tonumber(current) then
+	redis.call('zadd', KEYS[1], string.format('%.17g', high), 'max')
+end
+return {
+	redis.call('zincrby', KEYS[1], #ARGV - 1, 'count'),
+	redis.call('zincrby', KEYS[1], string.format('%.17g', sum), 'sum'),
+	redis.call('zincrby', KEYS[1], string.format('%.17g', sumsq), 'sumsq'),
+}
+''')
+
+def update_stats_batch(conn, context, type, values):
+	# 用一次脚本调用记录多个样本, 返回更新之后的 count、sum 和 sumsq
+	destination = 'stats:%s:%s' % (context, type)
+	hour_start = datetime(*datetime.utcnow().timetuple()[:4]).isoformat()
+	result = _update_stats_script(conn,
+		[destination, destination + ':start', destination + ':last',
+			destination + ':pstart'],
+		[hour_start] + [repr(float(value)) for value in values])
+	return [float(value) for value in result] if result else None
+
+def update_stats_scripted(conn, context, type, value):
+	# 与 update_stats() 的结果相同, 但只需要一次通信往返
+	return update_stats_batch(conn, context, type, [value])
+
+# 按小时分桶的统计数据保留的小时数
+STATS_HOURS = 3
+
+def hour_bucket(hours_ago=0, now=None):
+	# 返回 hours_ago 小时之前所处的小时, 用作统计数据键名的后缀
+	now = (now or time.time()) - hours_ago * 3600
+	return time.strftime('%Y-%m-%dT%H', time.gmtime(now))
+
+def update_stats_bucketed(conn, context, type, value):
+	# 不需要轮换的统计数据: 每个小时的数据写入以小时命名的键里面, 并且让键自动过期,
+	# 所以写入路径上不需要 WATCH, 也不会因为其他客户端的写入而重试
+	destination = 'stats:%s:%s:%s' % (context, type, hour_bucket())
+	pipe = conn.pipeline(True)
+	tkey1 = str(uuid.uuid4())
+	tkey2 = str(uuid.uuid4())
+	pipe.zadd(tkey1, 'min', value)
+	pipe.zadd(tkey2, 'max', value)
+	pipe.zunionstore(destination, [destination, tkey1], aggregate='min')
+	pipe.zunionstore(destination, [destination, tkey2], aggregate='max')
+	pipe.delete(tkey1, tkey2)
+	pipe.zincrby(destination, 'count')
+	pipe.zincrby(destination, 'sum', value)
+	pipe.zincrby(destination, 'sumsq', value * value)
+	pipe.expire(destination, STATS_HOURS * 3600)
+	return pipe.execute()[-4:-1]
+
+def get_stats(conn, context, type, hours_ago=None):
 	# 程序姜葱这个键里面去除统计数据
 	key = 'stats:%s:%s' % (context, type)
+	# 读取按小时分桶的统计数据: 0 为当前小时, 1 为上一个小时, 以此类推
+	if hours_ago is not None:
+		key += ':' + hour_bucket(hours_ago)
 	# 获取基本的统计数据， 并将它们都放在一个字典里面
 	data = dict(conn.zrange(key, 0, -1, withscores=True))
 	# 计算平均值
@@ -73,16 +187,207 @@ def get_stats(conn, context, type):
 	data['stddev'] = (numerator / (data[b'count'] - 1 or 1)) ** .5
 	return data
 
+def benchmark_update_stats(conn, function, writers=32, samples=100):
+	# 让 writers 个线程同时更新同一项统计数据, 返回每秒记录的样本数量
+	def writer():
+		for i in range(samples):
+			function(conn, 'bench', 'example', random.randrange(5, 15))
+	threads = [threading.Thread(target=writer) for i in range(writers)]
+	start = time.time()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return writers * samples / (time.time() - start)
+
+# 访问时长直方图: 第 i 个桶记录落在 (HIST_GAMMA**(i-1), HIST_GAMMA**i] 之间的样本
+# 数量, 用桶的中点估算样本值时的相对误差不超过 (HIST_GAMMA-1)/(HIST_GAMMA+1),
+# 也就是大约1%. 每个上下文每个小时的直方图是一个散列 hist:<上下文>:<小时>,
+# 字段为桶的编号, 值为样本数量. 不同上下文和不同小时的直方图可以直接按桶相加
+HIST_GAMMA = 1.02
+# 小于这个值的样本都被放进同一个桶里面
+HIST_MIN_VALUE = 1e-6
+_LOG_GAMMA = math.log(HIST_GAMMA)
+
+def histogram_bucket(value):
+	return int(math.ceil(math.log(max(value, HIST_MIN_VALUE)) / _LOG_GAMMA))
+
+def bucket_value(bucket):
+	# 桶的中点, 与桶里面任意样本的相对误差都不超过 (HIST_GAMMA-1)/(HIST_GAMMA+1)
+	return 2 * HIST_GAMMA ** bucket / (HIST_GAMMA + 1)
+
+# 当前进程里面所有的后台刷新器, 进程退出和 fork 时统一处理
+_FLUSHERS = []
+
+class BackgroundFlusher(object):
+	# 后台刷新线程的公共实现: 后台线程每隔 interval 秒, 或者在 _should_flush() 为真
+	# 时被 wake() 提前唤醒, 调用子类的 flush(). flush() 失败时应该先把取出的数据放回去
+	# 再抛出异常; 后台线程会把Redis错误记录在 stats['errors'] 和 last_error 里面,
+	# 等待 interval 秒之后重试, 而不会退出. fork 出来的子进程会在其他线程出现之前
+	# 丢弃从父进程继承的数据(它们由父进程负责写入)并重新启动仍在运行的后台线程.
+	# close() 或者进程退出时会停止后台线程并做最后一次 flush()
+	def __init__(self, interval):
+		self.interval = interval
+		self.stats = {'flushes': 0, 'errors': 0}
+		self.last_error = None
+		self._start()
+		_FLUSHERS.append(self)
+
+	def _start(self):
+		self.pid = os.getpid()
+		self.condition = threading.Condition()
+		self.running = True
+		self._reset()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _reset(self):
+		# 子类在这里创建需要刷新的数据
+		pass
+
+	def _should_flush(self):
+		return False
+
+	def wake(self):
+		with self.condition:
+			self.condition.notify_all()
+
+	def flush(self):
+		raise NotImplementedError
+
+	def _try_flush(self):
+		try:
+			self.flush()
+			return True
+		except redis.exceptions.RedisError as error:
+			self.stats['errors'] += 1
+			self.last_error = error
+			return False
+
+	def close(self):
+		# 停止后台线程并写入剩余的数据. 关闭之后的刷新器不再需要在 fork 和
+		# 进程退出时处理, 把它从 _FLUSHERS 里面移除
+		if self.pid != os.getpid():
+			return
+		if self in _FLUSHERS:
+			_FLUSHERS.remove(self)
+		if self.running:
+			with self.condition:
+				self.running = False
+				self.condition.notify_all()
+			self.thread.join()
+		self._try_flush()
+
+	def _run(self):
+		while self.running:
+			with self.condition:
+				if self.running and not self._should_flush():
+					self.condition.wait(self.interval)
+			if not self._try_flush():
+				# 出错之后等待一段时间再重试, 避免在Redis不可用时空转
+				with self.condition:
+					if self.running:
+						self.condition.wait(self.interval)
+
+def _restart_flushers():
+	for flusher in _FLUSHERS:
+		if flusher.running:
+			flusher._start()
+
+def _close_flushers():
+	# close() 会修改 _FLUSHERS, 所以遍历它的副本
+	for flusher in list(_FLUSHERS):
+		flusher.close()
+
+atexit.register(_close_flushers)
+os.register_at_fork(after_in_child=_restart_flushers)
+
+class HistogramRecorder(BackgroundFlusher):
+	# 在本地累加各个上下文的直方图, 后台线程每隔 interval 秒通过一个事务把增量用
+	# HINCRBY 写入当前小时的直方图, 所以多个进程可以同时写入同一个直方图.
+	# 写入失败的增量会被合并回本地, 在下一次写入时重试
+	def __init__(self, conn, interval=1):
+		self.conn = conn
+		BackgroundFlusher.__init__(self, interval)
+
+	def _reset(self):
+		self.pending = collections.defaultdict(int)
+
+	def record(self, context, value, now=None):
+		key = 'hist:%s:%s' % (context, hour_bucket(now=now))
+		with self.condition:
+			self.pending[key, histogram_bucket(value)] += 1
+
+	def flush(self):
+		with self.condition:
+			pending, self.pending = self.pending, collections.defaultdict(int)
+		if not pending:
+			return 0
+		pipe = self.conn.pipeline(True)
+		for (key, bucket), count in pending.items():
+			pipe.hincrby(key, bucket, count)
+		for key in set(key for key, bucket in pending):
+			pipe.expire(key, STATS_HOURS * 3600)
+		try:
+			pipe.execute()
+		except redis.exceptions.RedisError:
+			with self.condition:
+				for key, count in pending.items():
+					self.pending[key] += count
+			raise
+		self.stats['flushes'] += 1
+		return len(pending)
+
+def merge_histograms(conn, contexts, hours=1, now=None):
+	# 取出多个上下文在最近 hours 个小时里面的直方图, 并把它们合并成一个
+	if isinstance(contexts, str):
+		contexts = [contexts]
+	pipe = conn.pipeline(False)
+	for context in contexts:
+		for hours_ago in range(hours):
+			pipe.hgetall('hist:%s:%s' % (context, hour_bucket(hours_ago, now)))
+	merged = collections.defaultdict(int)
+	for data in pipe.execute():
+		for bucket, count in data.items():
+			merged[int(bucket)] += int(count)
+	return merged
+
+def get_percentiles(conn, context, percentiles, hours=1, now=None):
+	# 返回给定上下文(或者上下文列表)在最近 hours 个小时里面的各个分位数的估算值,
+	# 例如 get_percentiles(conn, 'req', [.5, .99]). 没有样本时返回 None
+	histogram = merge_histograms(conn, context, hours, now)
+	total = sum(histogram.values())
+	if not total:
+		return [None for p in percentiles]
+	buckets = sorted(histogram)
+	cumulative = []
+	seen = 0
+	for bucket in buckets:
+		seen += histogram[bucket]
+		cumulative.append(seen)
+	result = []
+	for p in percentiles:
+		# 找到第一个累计数量超过目标排名的桶
+		rank = p * (total - 1)
+		index = bisect.bisect_right(cumulative, rank)
+		result.append(bucket_value(buckets[min(index, len(buckets) - 1)]))
+	return result
+
 # 将这个Python生成器用作上下文管理器。
 @contextlib.contextmanager
-def access_time(conn, context):
+def access_time(conn, context, recorder=None):
 	# 记录代码块执行前的时间
 	start = time.time()
 	# 运行被包裹的代码块
 	yield
 	delta = time.time() - start
+	# 如果给定了 HistogramRecorder, 那么同时把访问时长记录到直方图里面,
+	# 以便之后通过 get_percentiles() 查询p95/p99等尾部延迟
+	if recorder:
+		recorder.record(context, delta)
 	# 更新这一上下文的统计数据
-	stats = update_stats(conn, context, 'AccessTime', delta)
+	stats = update_stats_scripted(conn, context, 'AccessTime', delta)
 	# 计算页面的平均访问时长
 	average = stats[1] / stats[0]
 
@@ -136,6 +441,106 @@ class TestCh05(unittest.TestCase):
 
 		self.assertTrue(rr[b'count'] >= 5)
 
+	def test_stats_bucketed(self):
+		conn = self.conn
+
+		print("Let's add some data to the hourly statistics")
+		for value in (5, 9, 13):
+			r = update_stats_bucketed(conn, 'temp', 'example', value)
+		print("We have some aggregate statistics:", r)
+		self.assertEqual(r, [3.0, 27.0, 275.0])
+		rr = get_stats(conn, 'temp', 'example', hours_ago=0)
+		self.assertEqual((rr[b'min'], rr[b'max'], rr['average']), (5, 13, 9))
+		self.assertTrue(conn.ttl('stats:temp:example:' + hour_bucket()) > 0)
+
+		print("Samples/sec with 32 concurrent writers:")
+		print("update_stats:", benchmark_update_stats(conn, update_stats, samples=20))
+		print("update_stats_bucketed:", benchmark_update_stats(conn, update_stats_bucketed, samples=20))
+
+	def test_stats_scripted(self):
+		conn = self.conn
+
+		print("Let's record some samples with the scripted update")
+		for value in (5, 9, 13):
+			r = update_stats_scripted(conn, 'temp', 'example', value)
+		print("We have some aggregate statistics:", r)
+		self.assertEqual(r, [3.0, 27.0, 275.0])
+		r = update_stats_batch(conn, 'temp', 'example', [1, 2.5, 20])
+		self.assertEqual(r, [6.0, 50.5, 682.25])
+		self.assertEqual(update_stats_batch(conn, 'temp', 'example', []), None)
+		rr = get_stats(conn, 'temp', 'example')
+		self.assertEqual((rr[b'min'], rr[b'max']), (1, 20))
+		self.assertEqual(conn.keys('????????-*'), [])
+
+		print("An old hour is rotated out before new samples are recorded")
+		conn.set('stats:temp:example:start', '2000-01-01T00:00:00')
+		r = update_stats_scripted(conn, 'temp', 'example', 7)
+		self.assertEqual(r, [1.0, 7.0, 49.0])
+		self.assertEqual(conn.zscore('stats:temp:example:last', 'count'), 6)
+		self.assertEqual(conn.get('stats:temp:example:pstart'), b'2000-01-01T00:00:00')
+
+		print("The scripted and the original update can be mixed on the same stats")
+		r = update_stats(conn, 'temp', 'example', 3)
+		self.assertEqual(r, [2.0, 10.0, 58.0])
+		r = update_stats_scripted(conn, 'temp', 'example', 1)
+		self.assertEqual(r, [3.0, 11.0, 59.0])
+		conn.set('stats:temp:example:start', '2000-01-01T00:00:00')
+		r = update_stats(conn, 'temp', 'example', 2)
+		self.assertEqual(r, [1.0, 2.0, 4.0])
+		self.assertEqual(conn.zscore('stats:temp:example:last', 'count'), 3)
+		rr = get_stats(conn, 'temp', 'example')
+		self.assertEqual((rr[b'min'], rr[b'max']), (2, 2))
+
+		print("Samples/sec with 32 concurrent writers:")
+		print("update_stats:", benchmark_update_stats(conn, update_stats, samples=20))
+		print("update_stats_scripted:", benchmark_update_stats(conn, update_stats_scripted, samples=20))
+		batch = lambda conn, context, type, value: update_stats_batch(
+			conn, context, type, [value] * 10)
+		print("update_stats_batch (x10):", 10 * benchmark_update_stats(conn, batch, samples=20))
+
+	def test_percentiles(self):
+		conn = self.conn
+
+		print("Let's record some access times in two contexts")
+		recorder = HistogramRecorder(conn, interval=60)
+		now = time.time()
+		for i in range(1, 1001):
+			recorder.record('a' if i % 2 else 'b', i / 1000.0, now)
+			recorder.record('a', 10, now - 3600)
+		recorder.close()
+		self.assertTrue(conn.ttl('hist:a:' + hour_bucket(now=now)) > 0)
+
+		p50, p99 = get_percentiles(conn, 'a', [.5, .99], now=now)
+		print("p50, p99 of a:", p50, p99)
+		self.assertAlmostEqual(p50, .5, delta=.5 * .01)
+		self.assertAlmostEqual(p99, .99, delta=.99 * .01)
+		p50, p99 = get_percentiles(conn, ['a', 'b'], [.5, .99], now=now)
+		print("p50, p99 of a and b:", p50, p99)
+		self.assertAlmostEqual(p50, .5, delta=.5 * .01)
+		self.assertAlmostEqual(p99, .99, delta=.99 * .01)
+		self.assertEqual(get_percentiles(conn, 'a', [.5], hours=2, now=now), [bucket_value(histogram_bucket(10))])
+		self.assertEqual(get_percentiles(conn, 'c', [.5, .99], now=now), [None, None])
+
+		print("access_time can feed the same histograms")
+		recorder = HistogramRecorder(conn, interval=60)
+		for i in range(3):
+			with access_time(conn, 'req', recorder):
+				time.sleep(.01)
+		recorder.close()
+		p50, = get_percentiles(conn, 'req', [.5])
+		self.assertTrue(.01 <= p50 < .1)
+
+		print("Failed flushes keep the samples and the flusher thread")
+		recorder = HistogramRecorder(redis.Redis(port=1, db=15), interval=.05)
+		recorder.record('failing', .5, now)
+		time.sleep(.2)
+		self.assertTrue(recorder.stats['errors'] > 0)
+		self.assertTrue(recorder.thread.is_alive())
+		recorder.record('failing', .5, now)
+		recorder.conn = conn
+		recorder.close()
+		self.assertEqual(sum(merge_histograms(conn, 'failing', now=now).values()), 2)
+
 	def test_access_time(self):
 		import pprint
 		conn = self.conn